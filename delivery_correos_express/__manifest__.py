@@ -12,5 +12,9 @@
     "installable": True,
     "depends": ["delivery_package_number", "delivery_state"],
     "external_dependencies": {"python": ["unidecode"]},
-    "data": ["views/delivery_carrier_view.xml", "views/stock_picking_views.xml"],
+    "data": [
+        "data/ir_cron_data.xml",
+        "views/delivery_carrier_view.xml",
+        "views/stock_picking_views.xml",
+    ],
 }
@@ -2,8 +2,13 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl)..
 
 import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from odoo.exceptions import UserError
 
@@ -36,6 +41,132 @@ CORREOS_EXPRESS_PORTES = [("P", "Paid"), ("D", "Due")]
 TEST_PATH = "https://www.test.cexpr.es/wsps/"
 PROD_PATH = "https://www.cexpr.es/wspsc/"
 
+# Errors worth retrying on idempotent calls: the request never reached the
+# server, it did not answer in time, or it answered with a transient status.
+RETRY_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+# Return code of the tracking endpoint when it has no shipment for the
+# reference ("no se han encontrado datos"). Any other code is an error.
+TRACKING_NOT_FOUND_CODE = 1
+
+# Maximum shipment numbers per ListEnvios request
+LIST_MAX_SHIPMENTS = 999
+
+# Consecutive transport failures that open the circuit, and seconds before
+# a request is let through again to probe the API.
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_COOLDOWN = 60
+
+# One keep-alive session and one circuit breaker per worker process,
+# environment and credentials.
+_sessions = {}
+_breakers = {}
+_sessions_lock = threading.Lock()
+
+
+class CorreosExpressUnavailable(requests.exceptions.ConnectionError):
+    """Raised instead of calling the API while the circuit is open."""
+
+
+class CircuitBreaker:
+    """Stop calling the API after ``threshold`` consecutive transport failures.
+
+    Once ``cooldown`` seconds have passed a single request is let through: if
+    it succeeds the circuit closes, if it fails it opens again.
+    """
+
+    def __init__(self, threshold=CIRCUIT_FAILURE_THRESHOLD, cooldown=CIRCUIT_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            # Half-open: one failure is enough to open it again
+            self.opened_at = None
+            self.failures = self.threshold - 1
+            return True
+
+    def is_open(self):
+        """Whether calls are currently refused, without using up the probe."""
+        with self._lock:
+            return (
+                self.opened_at is not None
+                and time.monotonic() - self.opened_at < self.cooldown
+            )
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold and self.opened_at is None:
+                self.opened_at = time.monotonic()
+                _logger.warning(
+                    "Correos Express: %s consecutive failures, pausing calls for %ss",
+                    self.failures,
+                    self.cooldown,
+                )
+
+
+def is_transient_error(error):
+    """Whether ``error`` is worth retrying later: the API was unreachable,
+    too slow or answered with a server-side status."""
+    if isinstance(error, RETRY_EXCEPTIONS):
+        return True
+    response = getattr(error, "response", None)
+    return response is not None and (
+        response.status_code in RETRY_STATUS_CODES or response.status_code >= 500
+    )
+
+
+class RateLimiter:
+    """Space calls out so that at most ``rate`` start per second, across
+    threads. A ``rate`` of 0 disables the limit."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next_call = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next_call - now
+            self._next_call = max(now, self._next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _get_breaker(key):
+    with _sessions_lock:
+        return _breakers.setdefault(key, CircuitBreaker())
+
+
+def _get_session(key, pool_size):
+    """Return the shared ``requests.Session`` for ``key``, creating it once."""
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[key] = session
+        return session
+
 
 class CorreosExpressRequest:
     def __init__(self, carrier):
@@ -45,50 +176,149 @@ class CorreosExpressRequest:
             "shipment": path + "apiRestGrabacionEnviok8s/json/grabacionEnvio",
             "label": path + "apiRestEtiquetaTransporte/json/etiquetaTransporte",
             "tracking": path + "apiRestSeguimientoEnviosk8s/json/seguimientoEnvio",
+            "list": path + "apiRestListaEnvios/json/listaEnvios",
         }
+        # Read the carrier settings once so the HTTP layer does not touch the ORM
+        self.auth = (
+            self.carrier_id.correos_express_username,
+            self.carrier_id.correos_express_password,
+        )
+        self.timeout = (
+            self.carrier_id.correos_express_connect_timeout or 10,
+            self.carrier_id.correos_express_read_timeout or 60,
+        )
+        self.max_retries = max(self.carrier_id.correos_express_max_retries, 0)
+        session_key = (self.carrier_id.prod_environment,) + self.auth
+        self.session = _get_session(
+            session_key, self.carrier_id.correos_express_pool_size or 10
+        )
+        self.breaker = _get_breaker(session_key)
 
-    def _send_api_request(self, request_type, url, data=None, skip_auth=False):
-        if data is None:
-            data = {}
+    def _retry_delay(self, attempt):
+        """Exponential backoff with jitter: ~0.5s, ~1s, ~2s..."""
+        return 0.5 * 2**attempt * random.uniform(0.5, 1.5)
+
+    def _request(self, request_type, url, data, auth, idempotent):
+        """Send the request, retrying idempotent calls on transient errors."""
+        attempt = 0
+        while True:
+            try:
+                if request_type == "GET":
+                    res = self.session.get(url=url, auth=auth, timeout=self.timeout)
+                else:
+                    res = self.session.post(
+                        url=url, auth=auth, json=data, timeout=self.timeout
+                    )
+                if (
+                    not idempotent
+                    or attempt >= self.max_retries
+                    or res.status_code not in RETRY_STATUS_CODES
+                ):
+                    return res
+            except RETRY_EXCEPTIONS:
+                if not idempotent or attempt >= self.max_retries:
+                    raise
+            delay = self._retry_delay(attempt)
+            attempt += 1
+            _logger.info(
+                "Correos Express: retrying %s in %.2fs (attempt %s of %s)",
+                url,
+                delay,
+                attempt,
+                self.max_retries,
+            )
+            time.sleep(delay)
+
+    def _fetch(self, request_type, url, data=None, skip_auth=False, idempotent=False):
+        """Send the request and decode the body.
+
+        Only does HTTP and never touches the ORM, so it is safe to call from
+        worker threads. Returns ``(result, error)`` instead of raising. While
+        the circuit breaker is open the API is not called at all.
+        """
         result = {}
+        if not self.breaker.allow():
+            return result, CorreosExpressUnavailable(
+                "Correos Express API unavailable, calls paused after "
+                f"{self.breaker.threshold} consecutive failures"
+            )
         try:
-            auth = tuple()
-            if not skip_auth:
-                auth = tuple(
-                    [
-                        self.carrier_id.correos_express_username,
-                        self.carrier_id.correos_express_password,
-                    ]
-                )
-            if request_type == "GET":
-                res = requests.get(url=url, auth=auth, timeout=60)
-            elif request_type == "POST":
-                _logger.debug(data)
-                res = requests.post(url=url, auth=auth, json=data, timeout=60)
+            auth = None if skip_auth else self.auth
+            res = self._request(request_type, url, data, auth, idempotent)
+            if res.status_code in RETRY_STATUS_CODES or res.status_code >= 500:
+                self.breaker.record_failure()
             else:
-                raise UserError(
-                    self.carrier_id.env._(
-                        "Unsupported request type, please only use 'GET' or 'POST'"
-                    )
-                )
-            result = res.json()
-            correos_express_last_request = f"URL: {url}\nData: {data}"
-            self.carrier_id.log_xml(
-                correos_express_last_request, "correos_express_last_request"
-            )
-            self.carrier_id.log_xml(result, "correos_express_last_response")
-            _logger.debug(res.json())
+                self.breaker.record_success()
+            try:
+                result = res.json()
+            except ValueError:
+                # Gateway error pages (502, 503...) are not JSON: report the
+                # HTTP error, which keeps the response, instead
+                res.raise_for_status()
+                raise
             res.raise_for_status()
-        except requests.exceptions.Timeout as tmo:
-            raise UserError(
-                self.carrier_id.env._("Timeout: the server did not reply within 60s")
-            ) from tmo
+        except RETRY_EXCEPTIONS as e:
+            self.breaker.record_failure()
+            return result, e
         except Exception as e:
+            return result, e
+        return result, None
+
+    def find_shipment(self, reference):
+        """Look up a shipment by the client reference it was registered with.
+
+        Returns ``(shipment number, error)``: the number is False when the API
+        does not know the reference, and ``error`` is set when the lookup
+        itself failed or returned any other error code, in which case nothing
+        can be concluded and the shipment must not be registered again.
+        """
+        result, error = self._fetch(
+            "POST",
+            self.urls["tracking"],
+            {
+                "codigoCliente": self.carrier_id.correos_express_customer_code,
+                "dato": reference,
+            },
+            idempotent=True,
+        )
+        if error:
+            return False, error
+        return_code, message = self._check_for_error(result)
+        if return_code == TRACKING_NOT_FOUND_CODE:
+            return False, None
+        if return_code != 0:
+            return False, UserError(
+                self.carrier_id.env._(
+                    "Correos Express Error: {return_code} {message}"
+                ).format(return_code=return_code, message=message)
+            )
+        return result.get("numEnvio") or False, None
+
+    def _handle_response(self, url, data, result, error):
+        """Log the exchange on the carrier and turn errors into ``UserError``.
+
+        Must run on the ORM thread.
+        """
+        correos_express_last_request = f"URL: {url}\nData: {data}"
+        self.carrier_id.log_xml(
+            correos_express_last_request, "correos_express_last_request"
+        )
+        self.carrier_id.log_xml(result, "correos_express_last_response")
+        _logger.debug(result)
+        if isinstance(error, requests.exceptions.Timeout):
+            raise UserError(
+                self.carrier_id.env._(
+                    "Timeout: the server did not reply within {timeout}s"
+                ).format(timeout=self.timeout[1])
+            ) from error
+        if error:
             raise UserError(
                 self.carrier_id.env._(
-                    "{error}\n{result}".format(error=e, result=result if result else "")
+                    "{error}\n{result}".format(
+                        error=error, result=result if result else ""
+                    )
                 )
-            ) from e
+            ) from error
         return_code, message = self._check_for_error(result)
         if return_code != 0:
             raise UserError(
@@ -96,7 +326,27 @@ class CorreosExpressRequest:
                     "Correos Express Error: {return_code} {message}"
                 ).format(return_code=return_code, message=message)
             )
-        return res
+        return result
+
+    def _send_api_request(
+        self, request_type, url, data=None, skip_auth=False, idempotent=False
+    ):
+        """Send the request and return the decoded JSON response.
+
+        Only ``idempotent`` calls (labels, tracking) are retried: retrying a
+        shipment registration could record the same shipment twice.
+        """
+        if data is None:
+            data = {}
+        if request_type not in ("GET", "POST"):
+            raise UserError(
+                self.carrier_id.env._(
+                    "Unsupported request type, please only use 'GET' or 'POST'"
+                )
+            )
+        _logger.debug(data)
+        result, error = self._fetch(request_type, url, data, skip_auth, idempotent)
+        return self._handle_response(url, data, result, error)
 
     def _check_for_error(self, result):
         return_code = 999
@@ -113,22 +363,80 @@ class CorreosExpressRequest:
         if not isinstance(result.get("error", "false"), str):
             return_code = result.get("error")
             message = result.get("mensajeError") or ""
+        # shipment list, codError comes as a string
+        if result.get("codError") is not None:
+            return_code = int(result.get("codError"))
+            message = result.get("desError") or ""
         return return_code, message
 
     def create_shipment(self, vals):
-        res = self._send_api_request(
+        return self._send_api_request(
             request_type="POST", url=self.urls["shipment"], data=vals
         )
-        return res.json()
+
+    def _send_many(self, url, vals_list, max_workers, idempotent=False, rate=0):
+        """POST every ``vals`` to ``url`` with at most ``max_workers`` requests
+        in flight and, if ``rate`` is set, no more than ``rate`` per second.
+        Returns one ``(result, error)`` pair per ``vals``, in order, where
+        ``error`` is the ``UserError`` the sequential call would raise.
+        """
+        limiter = RateLimiter(rate)
+
+        def fetch(vals):
+            limiter.wait()
+            return self._fetch("POST", url, vals, idempotent=idempotent)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            responses = list(executor.map(fetch, vals_list))
+        outcomes = []
+        for vals, (result, error) in zip(vals_list, responses, strict=True):
+            try:
+                result = self._handle_response(url, vals, result, error)
+                outcomes.append((result, None))
+            except UserError as e:
+                outcomes.append((None, e))
+        return outcomes
+
+    def create_shipments(self, vals_list, max_workers):
+        """Register several shipments concurrently, see ``_send_many``."""
+        return self._send_many(self.urls["shipment"], vals_list, max_workers)
+
+    def track_shipments(self, vals_list, max_workers, rate=0):
+        """Track several shipments concurrently, see ``_send_many``."""
+        return self._send_many(
+            self.urls["tracking"], vals_list, max_workers, idempotent=True, rate=rate
+        )
 
     def print_shipment(self, vals):
-        res = self._send_api_request(
-            request_type="POST", url=self.urls["label"], data=vals
+        result = self._send_api_request(
+            request_type="POST", url=self.urls["label"], data=vals, idempotent=True
         )
-        return res.json().get("listaEtiquetas", [])
+        return result.get("listaEtiquetas", [])
 
     def track_shipment(self, vals):
-        res = self._send_api_request(
-            request_type="POST", url=self.urls["tracking"], data=vals
+        return self._send_api_request(
+            request_type="POST", url=self.urls["tracking"], data=vals, idempotent=True
         )
-        return res.json()
+
+    def list_shipments(self, numbers):
+        """Current state of the given shipment numbers through ListEnvios.
+
+        The numbers are sent in requests of at most 999. Returns
+        ``{shipment number: listaEnvios entry}``; entries whose
+        ``codSeguimEnvio`` is not "0" were not found by Correos Express.
+        """
+        shipments = {}
+        numbers = list(numbers)
+        for start in range(0, len(numbers), LIST_MAX_SHIPMENTS):
+            result = self._send_api_request(
+                request_type="POST",
+                url=self.urls["list"],
+                data={
+                    "codigoCliente": self.carrier_id.correos_express_customer_code,
+                    "nEnvios": numbers[start : start + LIST_MAX_SHIPMENTS],
+                },
+                idempotent=True,
+            )
+            for shipment in result.get("listaEnvios") or []:
+                shipments[(shipment.get("nEnvio") or "").strip()] = shipment
+        return shipments
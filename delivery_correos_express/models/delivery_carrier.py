@@ -1,6 +1,9 @@
 # Copyright 2021 Studio73 - Ethan Hildick <ethan@studio73.es>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 import base64
+import logging
+import re
+from datetime import timedelta
 
 from unidecode import unidecode
 
@@ -14,6 +17,13 @@ from .correos_express_request import (
 )
 
 
+_logger = logging.getLogger(__name__)
+
+# Bounds of the interval between two tracking checks of a shipment
+TRACKING_MIN_DELAY = timedelta(hours=1)
+TRACKING_MAX_DELAY = timedelta(days=1)
+
+
 class DeliveryCarrier(models.Model):
     _inherit = "delivery.carrier"
 
@@ -37,6 +47,70 @@ class DeliveryCarrier(models.Model):
         selection=CORREOS_EXPRESS_PORTES,
         default="P",
     )
+    correos_express_connect_timeout = fields.Integer(
+        string="Correos Express Connect Timeout",
+        default=10,
+        help="Seconds to wait for the connection to the API to be established.",
+    )
+    correos_express_read_timeout = fields.Integer(
+        string="Correos Express Read Timeout",
+        default=60,
+        help="Seconds to wait for the API to answer once connected.",
+    )
+    correos_express_max_retries = fields.Integer(
+        string="Correos Express Retries",
+        default=2,
+        help="Retries with backoff for label and tracking requests on connection "
+        "errors, timeouts and transient server errors. Shipment registrations "
+        "are never retried automatically.",
+    )
+    correos_express_shipping_mode = fields.Selection(
+        string="Correos Express Shipping Mode",
+        selection=[("sync", "On validation"), ("queue", "Queued")],
+        default="sync",
+        help="Queued: validating a picking only records a pending shipment, "
+        "which a scheduled action registers in the background, so a slow or "
+        "unavailable API does not block or roll back the validation.",
+    )
+    correos_express_max_attempts = fields.Integer(
+        string="Correos Express Shipment Attempts",
+        default=5,
+        help="Attempts of a queued shipment on connection errors before it is "
+        "marked as failed.",
+    )
+    correos_express_max_workers = fields.Integer(
+        string="Correos Express Parallel Shipments",
+        default=1,
+        help="Maximum shipment registrations sent at the same time when several "
+        "pickings are validated together. 1 registers them one by one.",
+    )
+    correos_express_terminal_states = fields.Char(
+        string="Correos Express Final States",
+        default="12",
+        help="Comma-separated codEstado values after which a shipment is no "
+        "longer tracked (delivered, returned...).",
+    )
+    correos_express_tracking_workers = fields.Integer(
+        string="Correos Express Parallel Tracking",
+        default=8,
+        help="Tracking requests sent at the same time by the tracking update.",
+    )
+    correos_express_tracking_rate = fields.Float(
+        string="Correos Express Tracking Rate",
+        default=10,
+        help="Maximum tracking requests per second. 0 means no limit.",
+    )
+    correos_express_reconcile_days = fields.Integer(
+        string="Correos Express Reconciliation Days",
+        default=30,
+        help="The daily reconciliation checks the open shipments of the pickings "
+        "done in this many last days.",
+    )
+    correos_express_pool_size = fields.Integer(
+        string="Correos Express Connection Pool",
+        default=10,
+        help="Keep-alive connections to the API kept open per worker process.",
+    )
 
     def correos_express_get_tracking_link(self, picking):
         tracking_url = "https://s.correosexpress.com/c?n={}"
@@ -123,7 +197,7 @@ class DeliveryCarrier(models.Model):
                 "canalEntrada": "",
                 "numEnvio": "",
                 "ref": picking.name,
-                "refCliente": picking.name,
+                "refCliente": picking.correos_express_idempotency_key or picking.name,
                 "fecha": fields.Datetime.now().strftime("%d%m%Y"),  # mandatory
                 "contacOtrs": "",
                 "telefOtrs": "",
@@ -152,46 +226,84 @@ class DeliveryCarrier(models.Model):
             **self._get_correos_express_receiver_info(picking),
         )
 
+    def _correos_express_apply_shipment(self, picking, vals, response):
+        if not response:
+            return vals
+        is_pdf = self.correos_express_label_type != "2"
+        vals.update(
+            {
+                "tracking_number": response.get("datosResultado", ""),
+                "exact_price": 0,
+            }
+        )
+        attachments = []
+        if response.get("etiqueta"):
+            # To decode the label with Base64 we need to decode it first
+            # to binary and afterwards decode again to transform it
+            # into a PDF or text document
+            attachments = [
+                (
+                    "correos_express_{}_{}.{}".format(
+                        response.get("datosResultado", ""),
+                        index + 1,
+                        "pdf" if is_pdf else "txt",
+                    ),
+                    (
+                        base64.b64decode(base64.b64decode(label.get("etiqueta1", "")))
+                        if is_pdf
+                        else label.get("etiqueta2", "")
+                    ),
+                )
+                for index, label in enumerate(response.get("etiqueta"))
+            ]
+        picking.message_post(body=_(""), attachments=attachments)
+        return vals
+
+    def _correos_express_register_shipments(self, pickings):
+        """Register the shipments of ``pickings`` concurrently.
+
+        Payloads are built and results applied here, on the ORM thread; only
+        the HTTP calls run in the thread pool. A failed registration is posted
+        on its picking and returned without tracking number, so the other
+        shipments are kept. Returns ``{picking id: send_shipping vals}``.
+        """
+        self.ensure_one()
+        correos_express_request = CorreosExpressRequest(self)
+        vals_list = [self._prepare_correos_express_shipping(p) for p in pickings]
+        outcomes = correos_express_request.create_shipments(
+            vals_list, self.correos_express_max_workers
+        )
+        shipments = {}
+        for picking, vals, (response, error) in zip(
+            pickings, vals_list, outcomes, strict=True
+        ):
+            if error:
+                picking.message_post(
+                    body=_("Correos Express shipment could not be registered: %s")
+                    % error.args[0]
+                )
+                vals.update({"tracking_number": False, "exact_price": 0})
+            else:
+                self._correos_express_apply_shipment(picking, vals, response)
+            shipments[picking.id] = vals
+        return shipments
+
     def correos_express_send_shipping(self, pickings):
+        # Shipments already registered concurrently for the whole validation
+        prefetched = self.env.context.get("correos_express_prefetched_shipments") or {}
+        if pickings and all(picking.id in prefetched for picking in pickings):
+            return [prefetched[picking.id] for picking in pickings]
+        if self.correos_express_shipping_mode == "queue":
+            return pickings._correos_express_queue_shipment()
+        if self.correos_express_max_workers > 1 and len(pickings) > 1:
+            shipments = self._correos_express_register_shipments(pickings)
+            return [shipments[picking.id] for picking in pickings]
         correos_express_request = CorreosExpressRequest(self)
         result = []
-        is_pdf = self.correos_express_label_type != "2"
         for picking in pickings:
             vals = self._prepare_correos_express_shipping(picking)
             response = correos_express_request.create_shipment(vals)
-            if not response:
-                result.append(vals)
-                continue
-            vals.update(
-                {
-                    "tracking_number": response.get("datosResultado", ""),
-                    "exact_price": 0,
-                }
-            )
-            attachments = []
-            if response.get("etiqueta"):
-                # To decode the label with Base64 we need to decode it first
-                # to binary and afterwards decode again to transform it
-                # into a PDF or text document
-                attachments = [
-                    (
-                        "correos_express_{}_{}.{}".format(
-                            response.get("datosResultado", ""),
-                            index + 1,
-                            "pdf" if is_pdf else "txt",
-                        ),
-                        (
-                            base64.b64decode(
-                                base64.b64decode(label.get("etiqueta1", ""))
-                            )
-                            if is_pdf
-                            else label.get("etiqueta2", "")
-                        ),
-                    )
-                    for index, label in enumerate(response.get("etiqueta"))
-                ]
-            picking.message_post(body=_(""), attachments=attachments)
-            result.append(vals)
+            result.append(self._correos_express_apply_shipment(picking, vals, response))
         return result
 
     def _prepare_correos_express_tracking(self, picking):
@@ -200,6 +312,107 @@ class DeliveryCarrier(models.Model):
             "dato": picking.carrier_tracking_ref,
         }
 
+    def _get_correos_express_terminal_states(self):
+        return {
+            code.strip()
+            for code in (self.correos_express_terminal_states or "").split(",")
+            if code.strip()
+        }
+
+    def _correos_express_event_key(self, event):
+        """Sortable key of a tracking event: AAAAMMDDHHMMSS + codEstado."""
+        date = event.get("fechaEstado") or ""
+        return "{}{}{}{}{}".format(
+            date[4:],
+            date[2:-4],
+            date[:2],
+            event.get("horaEstado") or "",
+            event.get("codEstado") or "",
+        )
+
+    def _format_correos_express_event(self, event):
+        return "{} {} - [{}] {}".format(
+            "{}:{}:{}".format(
+                event.get("horaEstado")[:2],
+                event.get("horaEstado")[2:-2],
+                event.get("horaEstado")[-2:],
+            ),
+            "{}/{}/{}".format(
+                event.get("fechaEstado")[:2],
+                event.get("fechaEstado")[2:-4],
+                event.get("fechaEstado")[4:],
+            ),
+            event.get("codEstado"),
+            event.get("descEstado"),
+        )
+
+    def _correos_express_apply_tracking(self, picking, result):
+        """Store the tracking events of ``result`` that ``picking`` does not
+        have yet and schedule its next check.
+
+        Nothing is written to the history when there is no new event. Pickings
+        without a last event key (tracked before it was stored) get their
+        history rebuilt from all the events instead, as it already holds
+        them. The polling interval grows with the time the shipment has not
+        moved, and shipments in a final state are no longer tracked.
+        """
+        now = fields.Datetime.now()
+        last_key = picking.correos_express_last_event or ""
+        tracking_events = sorted(
+            (result or {}).get("estadoEnvios") or [],
+            key=self._correos_express_event_key,
+        )
+        new_events = [
+            event
+            for event in tracking_events
+            if self._correos_express_event_key(event) > last_key
+        ]
+        vals = {}
+        if new_events:
+            tracking = new_events[-1]
+            history = "\n".join(
+                self._format_correos_express_event(event) for event in new_events
+            )
+            previous_history = last_key and picking.tracking_state_history
+            vals.update(
+                {
+                    "tracking_state_history": "\n".join(
+                        filter(None, [previous_history, history])
+                    ),
+                    "tracking_state": "[{}] {}".format(
+                        tracking.get("codEstado"), tracking.get("descEstado")
+                    ),
+                    "correos_express_last_event": self._correos_express_event_key(
+                        tracking
+                    ),
+                    "correos_express_last_move_date": now,
+                }
+            )
+        last_code = tracking_events[-1].get("codEstado") if tracking_events else False
+        if last_code in self._get_correos_express_terminal_states():
+            vals.update(
+                {
+                    "correos_express_tracking_closed": True,
+                    "correos_express_next_tracking": False,
+                }
+            )
+        else:
+            last_move_date = (
+                vals.get("correos_express_last_move_date")
+                or picking.correos_express_last_move_date
+                or picking.date_done
+            )
+            vals["correos_express_next_tracking"] = (
+                now + self._get_correos_express_tracking_delay(last_move_date, now)
+            )
+        picking.write(vals)
+
+    def _get_correos_express_tracking_delay(self, last_move_date, now):
+        """A quarter of the time the shipment has not moved, between one hour
+        and one day."""
+        idle = now - (last_move_date or now)
+        return min(max(idle / 4, TRACKING_MIN_DELAY), TRACKING_MAX_DELAY)
+
     def correos_express_tracking_state_update(self, picking):
         self.ensure_one()
         if not picking.carrier_tracking_ref:
@@ -210,30 +423,80 @@ class DeliveryCarrier(models.Model):
         )
         if not result:
             return
-        tracking_events = result.get("estadoEnvios", [])
-        picking.tracking_state_history = "\n".join(
-            [
-                "{} {} - [{}] {}".format(
-                    "{}:{}:{}".format(
-                        t.get("horaEstado")[:2],
-                        t.get("horaEstado")[2:-2],
-                        t.get("horaEstado")[-2:],
-                    ),
-                    "{}/{}/{}".format(
-                        t.get("fechaEstado")[:2],
-                        t.get("fechaEstado")[2:-4],
-                        t.get("fechaEstado")[4:],
-                    ),
-                    t.get("codEstado"),
-                    t.get("descEstado"),
-                )
-                for t in tracking_events
-            ]
+        self._correos_express_apply_tracking(picking, result)
+
+    def _correos_express_update_tracking(self, pickings):
+        """Track ``pickings`` concurrently, within the carrier rate limit.
+
+        A failed request only postpones the next check of its picking.
+        """
+        self.ensure_one()
+        correos_express_request = CorreosExpressRequest(self)
+        outcomes = correos_express_request.track_shipments(
+            [self._prepare_correos_express_tracking(p) for p in pickings],
+            max(self.correos_express_tracking_workers, 1),
+            self.correos_express_tracking_rate,
         )
-        tracking = tracking_events.pop()
-        picking.tracking_state = "[{}] {}".format(
-            tracking.get("codEstado"), tracking.get("descEstado")
+        retry_date = fields.Datetime.now() + TRACKING_MIN_DELAY
+        failed = self.env["stock.picking"]
+        for picking, (result, error) in zip(pickings, outcomes, strict=True):
+            if error:
+                failed |= picking
+                continue
+            self._correos_express_apply_tracking(picking, result)
+        if failed:
+            _logger.warning(
+                "Correos Express: tracking failed for %s of %s pickings",
+                len(failed),
+                len(pickings),
+            )
+            failed.write({"correos_express_next_tracking": retry_date})
+
+    def _correos_express_list_event(self, shipment):
+        """Turn a ListEnvios entry into a tracking event, so it can be stored
+        like the ones of the tracking endpoint. fechaEstado is documented both
+        as "aaaammdd hh:mm:ss" and as "aaaa-mm-dd hh:mm:ss.0"."""
+        digits = re.sub(r"\D", "", shipment.get("fechaEstado") or "")
+        return {
+            "codEstado": shipment.get("codigoEstado"),
+            "descEstado": shipment.get("descripcionEstado"),
+            "fechaEstado": "{}{}{}".format(digits[6:8], digits[4:6], digits[:4]),
+            "horaEstado": digits[8:14],
+        }
+
+    def _correos_express_reconcile(self, pickings):
+        """Check the state of ``pickings`` with the ListEnvios endpoint, a
+        request per 999 shipments, matching them by ``carrier_tracking_ref``.
+
+        ListEnvios only returns the current state, so it is only used to skip
+        the pickings whose last stored event is still the current one: their
+        next check is rescheduled. The others, and the shipments it does not
+        return or does not find, are tracked one by one so that the
+        intermediate events are stored too. Returns those pickings.
+        """
+        self.ensure_one()
+        correos_express_request = CorreosExpressRequest(self)
+        shipments = correos_express_request.list_shipments(
+            pickings.mapped(lambda p: p.carrier_tracking_ref.strip())
         )
+        to_track = self.env["stock.picking"]
+        for picking in pickings:
+            shipment = shipments.get(picking.carrier_tracking_ref.strip())
+            if (
+                not shipment
+                or shipment.get("codSeguimEnvio") != "0"
+                or not shipment.get("codigoEstado")
+                or self._correos_express_event_key(
+                    self._correos_express_list_event(shipment)
+                )
+                > (picking.correos_express_last_event or "")
+            ):
+                to_track |= picking
+                continue
+            self._correos_express_apply_tracking(picking, {})
+        if to_track:
+            self._correos_express_update_tracking(to_track)
+        return to_track
 
     def correos_express_cancel_shipment(self, pickings):
         for picking in pickings.filtered("carrier_tracking_ref"):
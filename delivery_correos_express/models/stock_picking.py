@@ -2,14 +2,95 @@
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
 import base64
+import logging
+from datetime import timedelta
 
-from odoo import _, models
+from odoo import _, api, fields, models
 from odoo.exceptions import UserError
 
+from .correos_express_request import (
+    CorreosExpressRequest,
+    CorreosExpressUnavailable,
+    is_transient_error,
+)
+
+_logger = logging.getLogger(__name__)
+
 
 class StockPicking(models.Model):
     _inherit = "stock.picking"
 
+    correos_express_shipment_state = fields.Selection(
+        selection=[("pending", "Pending"), ("failed", "Failed"), ("sent", "Sent")],
+        string="Correos Express Shipment",
+        copy=False,
+        readonly=True,
+        index=True,
+        help="State of the shipment registration when the carrier works in "
+        "queued mode.",
+    )
+    correos_express_idempotency_key = fields.Char(
+        string="Correos Express Reference",
+        copy=False,
+        readonly=True,
+        help="Client reference the shipment is registered with. It is used to "
+        "check whether an interrupted attempt already reached Correos Express "
+        "before retrying it.",
+    )
+    correos_express_shipment_attempts = fields.Integer(copy=False, readonly=True)
+    correos_express_shipment_error = fields.Char(copy=False, readonly=True)
+    correos_express_last_event = fields.Char(
+        copy=False,
+        readonly=True,
+        help="Key of the last tracking event stored, to only add newer ones.",
+    )
+    correos_express_last_move_date = fields.Datetime(
+        string="Correos Express Last Movement",
+        copy=False,
+        readonly=True,
+        help="When a new tracking event was last found for the shipment.",
+    )
+    correos_express_next_tracking = fields.Datetime(
+        string="Correos Express Next Tracking",
+        copy=False,
+        readonly=True,
+        index=True,
+    )
+    correos_express_tracking_closed = fields.Boolean(
+        string="Correos Express Tracking Closed",
+        copy=False,
+        readonly=True,
+        help="The shipment reached a final state and is no longer tracked.",
+    )
+
+    def _send_confirmation_email(self):
+        # stock_delivery sends the pickings to the carrier one by one; register
+        # the Correos Express ones concurrently first and let send_to_shipper
+        # pick up the results.
+        prefetched = {}
+        for carrier in self.carrier_id.filtered(
+            lambda c: c.delivery_type == "correos_express"
+            and c.correos_express_shipping_mode != "queue"
+            and c.correos_express_max_workers > 1
+        ):
+            pickings = self.filtered(
+                lambda p, carrier=carrier: p.carrier_id == carrier
+                and carrier.integration_level == "rate_and_ship"
+                and p.picking_type_code != "incoming"
+                and not p.carrier_tracking_ref
+                and p.picking_type_id.print_label
+            )
+            if len(pickings) > 1:
+                prefetched.update(
+                    carrier.sudo()._correos_express_register_shipments(pickings)
+                )
+        pickings = self
+        if prefetched:
+            pickings = self.with_context(
+                correos_express_prefetched_shipments=prefetched
+            )
+        return super(StockPicking, pickings)._send_confirmation_email()
+
     def correos_express_get_label(self):
         self.ensure_one()
         tracking_ref = self.carrier_tracking_ref
@@ -35,3 +116,230 @@ class StockPicking(models.Model):
         )
         # We return label in case it wants to be used in an inheritance
         return decoded_labels
+
+    def _get_correos_express_idempotency_key(self):
+        # Alphanumeric, 8 to 20 characters, so it can be searched as a
+        # reference in the tracking API; the database prefix keeps it unique
+        # when several databases share the same Correos Express client code.
+        dbuuid = self.env["ir.config_parameter"].sudo().get_param("database.uuid", "")
+        return "OD{}{:010d}".format(dbuuid[:4].upper(), self.id)
+
+    def _correos_express_queue_shipment(self):
+        """Record pending shipments instead of calling the API.
+
+        Returns the ``send_shipping`` values, without tracking number.
+        """
+        for picking in self:
+            picking.write(
+                {
+                    "correos_express_shipment_state": "pending",
+                    "correos_express_idempotency_key": (
+                        picking.correos_express_idempotency_key
+                        or picking._get_correos_express_idempotency_key()
+                    ),
+                    "correos_express_shipment_attempts": 0,
+                    "correos_express_shipment_error": False,
+                }
+            )
+            picking.message_post(
+                body=_(
+                    "Correos Express shipment queued, it will be registered shortly."
+                )
+            )
+        self.env.ref(
+            "delivery_correos_express.ir_cron_correos_express_send_queued"
+        ).sudo()._trigger()
+        return [{"exact_price": 0, "tracking_number": False} for _picking in self]
+
+    def action_correos_express_retry_shipment(self):
+        # The last error is kept so the retry looks the reference up first
+        self.filtered(lambda p: p.correos_express_shipment_state == "failed").write(
+            {
+                "correos_express_shipment_state": "pending",
+                "correos_express_shipment_attempts": 0,
+            }
+        )
+        self.env.ref(
+            "delivery_correos_express.ir_cron_correos_express_send_queued"
+        ).sudo()._trigger()
+
+    @api.model
+    def _cron_correos_express_send_queued(self):
+        """Register the pending shipments, committing after each one.
+
+        A carrier whose circuit breaker is open is skipped until the next run.
+        """
+        pickings = self.search(
+            [("correos_express_shipment_state", "=", "pending")], order="id"
+        )
+        for carrier in pickings.carrier_id:
+            correos_express_request = CorreosExpressRequest(carrier)
+            for picking in pickings.filtered(lambda p, c=carrier: p.carrier_id == c):
+                if not picking._correos_express_send_queued_shipment(
+                    correos_express_request
+                ):
+                    break
+                if not self.env.registry.in_test_mode():
+                    self.env.cr.commit()  # pylint: disable=invalid-commit
+
+    def _correos_express_send_queued_shipment(self, correos_express_request):
+        """Register one queued shipment.
+
+        Every attempt is recorded and committed before the registration is
+        sent, and any later attempt first looks the reference up, so a
+        shipment whose previous attempt reached Correos Express is never
+        registered twice, even if the worker died before committing the
+        result. Returns False when the API is unavailable and the carrier
+        should be skipped.
+        """
+        self.ensure_one()
+        carrier = self.carrier_id
+        if (
+            self.correos_express_shipment_attempts
+            or self.correos_express_shipment_error
+        ):
+            tracking_number, error = correos_express_request.find_shipment(
+                self.correos_express_idempotency_key
+            )
+            if error:
+                return self._correos_express_shipment_retry_later(error)
+            if tracking_number:
+                self._correos_express_shipment_sent(tracking_number)
+                try:
+                    self.correos_express_get_label()
+                except UserError as e:
+                    self.message_post(body=str(e))
+                return True
+        if correos_express_request.breaker.is_open():
+            return False
+        vals = carrier._prepare_correos_express_shipping(self)
+        self.correos_express_shipment_attempts += 1
+        self.env.flush_all()
+        if not self.env.registry.in_test_mode():
+            self.env.cr.commit()  # pylint: disable=invalid-commit
+        url = correos_express_request.urls["shipment"]
+        result, error = correos_express_request._fetch("POST", url, vals)
+        if is_transient_error(error):
+            return self._correos_express_shipment_retry_later(
+                error, count_attempt=False
+            )
+        try:
+            response = correos_express_request._handle_response(
+                url, vals, result, error
+            )
+        except UserError as e:
+            self.write(
+                {
+                    "correos_express_shipment_state": "failed",
+                    "correos_express_shipment_error": str(e),
+                }
+            )
+            self.message_post(
+                body=_("Correos Express shipment could not be registered: %s")
+                % str(e)
+            )
+            return True
+        carrier._correos_express_apply_shipment(self, vals, response)
+        self._correos_express_shipment_sent(vals["tracking_number"])
+        return True
+
+    def _correos_express_shipment_retry_later(self, error, count_attempt=True):
+        if isinstance(error, CorreosExpressUnavailable):
+            # Nothing was sent; the carrier is skipped until the next run
+            return False
+        attempts = self.correos_express_shipment_attempts + int(count_attempt)
+        failed = attempts >= self.carrier_id.correos_express_max_attempts
+        self.write(
+            {
+                "correos_express_shipment_attempts": attempts,
+                "correos_express_shipment_error": str(error),
+                "correos_express_shipment_state": "failed" if failed else "pending",
+            }
+        )
+        if failed:
+            self.message_post(
+                body=_("Correos Express shipment could not be registered: %s")
+                % str(error)
+            )
+        return True
+
+    def _correos_express_shipment_sent(self, tracking_number):
+        self.write(
+            {
+                "carrier_tracking_ref": tracking_number,
+                "correos_express_shipment_state": "sent",
+                "correos_express_shipment_error": False,
+            }
+        )
+        self.message_post(
+            body=_("Correos Express shipment registered with tracking number %s")
+            % tracking_number
+        )
+
+    @api.model
+    def _cron_correos_express_update_tracking(self, batch_size=500):
+        """Update the tracking of every open Correos Express shipment that is
+        due, by batches, committing after each batch.
+        """
+        now = fields.Datetime.now()
+        domain = [
+            ("delivery_type", "=", "correos_express"),
+            ("carrier_tracking_ref", "!=", False),
+            ("state", "=", "done"),
+            ("correos_express_tracking_closed", "=", False),
+            "|",
+            ("correos_express_next_tracking", "=", False),
+            ("correos_express_next_tracking", "<=", now),
+        ]
+        while True:
+            pickings = self.search(domain, order="id", limit=batch_size)
+            if not pickings:
+                break
+            # Every picking gets a later next check, so the loop ends
+            for carrier in pickings.carrier_id:
+                carrier._correos_express_update_tracking(
+                    pickings.filtered(lambda p, c=carrier: p.carrier_id == c)
+                )
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()  # pylint: disable=invalid-commit
+
+    @api.model
+    def _cron_correos_express_reconcile(self):
+        """Daily reconciliation of the open Correos Express shipments of each
+        carrier through the ListEnvios endpoint."""
+        now = fields.Datetime.now()
+        carriers = self.env["delivery.carrier"].search(
+            [("delivery_type", "=", "correos_express")]
+        )
+        for carrier in carriers:
+            pickings = self.search(
+                [
+                    ("carrier_id", "=", carrier.id),
+                    ("carrier_tracking_ref", "!=", False),
+                    ("state", "=", "done"),
+                    ("correos_express_tracking_closed", "=", False),
+                    (
+                        "date_done",
+                        ">=",
+                        now - timedelta(days=carrier.correos_express_reconcile_days),
+                    ),
+                ]
+            )
+            if not pickings:
+                continue
+            try:
+                tracked = carrier._correos_express_reconcile(pickings)
+            except UserError as e:
+                _logger.warning(
+                    "Correos Express: reconciliation of %s failed: %s", carrier.name, e
+                )
+                continue
+            _logger.info(
+                "Correos Express: %s shipments reconciled for %s, "
+                "%s tracked one by one",
+                len(pickings),
+                carrier.name,
+                len(tracked),
+            )
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()  # pylint: disable=invalid-commit
@@ -9,13 +9,16 @@ from odoo.exceptions import UserError
 from odoo.tests import common
 
 from odoo.addons.delivery_correos_express.models.correos_express_request import (
+    CircuitBreaker,
     CorreosExpressRequest,
+    CorreosExpressUnavailable,
+    is_transient_error,
 )
 
-request_model = (
-    "odoo.addons.delivery_correos_express.models."
-    "correos_express_request.CorreosExpressRequest"
+request_module = (
+    "odoo.addons.delivery_correos_express.models.correos_express_request"
 )
+request_model = f"{request_module}.CorreosExpressRequest"
 
 
 class TestCorreosExpressRequest(common.SingleTransactionCase):
@@ -37,19 +40,29 @@ class TestCorreosExpressRequest(common.SingleTransactionCase):
 
         cls.correos_express_request = CorreosExpressRequest(cls.carrier_correos_express)
 
-    @mock.patch("requests.post")
+    def setUp(self):
+        super().setUp()
+        # The circuit breakers live as long as the worker process: every test
+        # starts with closed ones, and the ones of the process are restored
+        patcher = mock.patch.dict(f"{request_module}._breakers", clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.correos_express_request.breaker = CircuitBreaker()
+
+    @mock.patch("requests.Session.post")
     def test_01_send_api_request_success(self, mock_post):
         mock_post.return_value.json.return_value = {
             "codigoRetorno": 0,
             "mensajeRetorno": "OK",
         }
         mock_post.return_value.raise_for_status.return_value = None
+        mock_post.return_value.status_code = 200
         response = self.correos_express_request._send_api_request(
             "POST", "https://test.url", data={"test": "data"}
         )
-        self.assertEqual(response.json(), {"codigoRetorno": 0, "mensajeRetorno": "OK"})
+        self.assertEqual(response, {"codigoRetorno": 0, "mensajeRetorno": "OK"})
 
-    @mock.patch("requests.post")
+    @mock.patch("requests.Session.post")
     def test_02_send_api_request_timeout(self, mock_post):
         self.env = self.env(context=dict(self.env.context, lang="en_US"))
         mock_post.side_effect = requests.exceptions.Timeout()
@@ -58,7 +71,7 @@ class TestCorreosExpressRequest(common.SingleTransactionCase):
                 "POST", "https://test.url", data={"test": "data"}
             )
 
-    @mock.patch("requests.post")
+    @mock.patch("requests.Session.post")
     def test_03_send_api_request_error(self, mock_post):
         mock_post.side_effect = Exception("Test Error")
         with self.assertRaises(UserError):
@@ -66,6 +79,34 @@ class TestCorreosExpressRequest(common.SingleTransactionCase):
                 "POST", "https://test.url", data={"test": "data"}
             )
 
+    @mock.patch(f"{request_module}.time.sleep")
+    @mock.patch("requests.Session.post")
+    def test_15_send_api_request_retry_idempotent(self, mock_post, mock_sleep):
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {"error": 0, "mensajeError": ""}
+        mock_post.side_effect = [requests.exceptions.ConnectionError(), response]
+        result = self.correos_express_request._send_api_request(
+            "POST", "https://test.url", data={"test": "data"}, idempotent=True
+        )
+        self.assertEqual(result, {"error": 0, "mensajeError": ""})
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(mock_sleep.call_count, 1)
+
+    @mock.patch(f"{request_module}.time.sleep")
+    @mock.patch("requests.Session.post")
+    def test_16_send_api_request_no_retry_shipment(self, mock_post, mock_sleep):
+        mock_post.side_effect = requests.exceptions.ConnectionError()
+        with self.assertRaises(UserError):
+            self.correos_express_request._send_api_request(
+                "POST", "https://test.url", data={"test": "data"}
+            )
+        self.assertEqual(mock_post.call_count, 1)
+        mock_sleep.assert_not_called()
+
+    def test_17_session_shared(self):
+        other_request = CorreosExpressRequest(self.carrier_correos_express)
+        self.assertIs(other_request.session, self.correos_express_request.session)
+
     def test_04_check_for_error_shipment_success(self):
         result = {"codigoRetorno": 0, "mensajeRetorno": ""}
         return_code, message = self.correos_express_request._check_for_error(result)
@@ -107,3 +148,88 @@ class TestCorreosExpressRequest(common.SingleTransactionCase):
         return_code, message = self.correos_express_request._check_for_error(result)
         self.assertEqual(return_code, 999)
         self.assertEqual(message, "Webservice ERROR.")
+
+    def test_09_circuit_breaker(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=60)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        # After the cooldown one probe goes through and a success closes it
+        breaker.opened_at -= 60
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+
+    @mock.patch("requests.Session.post")
+    def test_10_send_api_request_circuit_open(self, mock_post):
+        request = CorreosExpressRequest(self.carrier_correos_express)
+        request.breaker = CircuitBreaker(threshold=1, cooldown=60)
+        request.breaker.record_failure()
+        result, error = request._fetch("POST", "https://test.url", {"test": "data"})
+        self.assertEqual(result, {})
+        self.assertIsInstance(error, CorreosExpressUnavailable)
+        mock_post.assert_not_called()
+
+    def test_11_check_for_error_list(self):
+        result = {"codError": "4", "desError": "Too many"}
+        return_code, message = self.correos_express_request._check_for_error(result)
+        self.assertEqual(return_code, 4)
+        self.assertEqual(message, "Too many")
+
+    @mock.patch("requests.Session.post")
+    def test_12_list_shipments_chunks(self, mock_post):
+        def post(url, auth=None, json=None, timeout=None):
+            response = mock.Mock(status_code=200)
+            response.json.return_value = {
+                "codError": "0",
+                "desError": None,
+                "listaEnvios": [
+                    {"nEnvio": f" {number} ", "codSeguimEnvio": "0"}
+                    for number in json["nEnvios"]
+                ],
+            }
+            return response
+
+        mock_post.side_effect = post
+        numbers = [f"{n:016d}" for n in range(1000)]
+        shipments = self.correos_express_request.list_shipments(numbers)
+        self.assertEqual(mock_post.call_count, 2)
+        first_request = mock_post.call_args_list[0].kwargs["json"]
+        self.assertEqual(len(first_request["nEnvios"]), 999)
+        self.assertEqual(sorted(shipments), numbers)
+
+    @mock.patch("requests.Session.post")
+    def test_13_fetch_gateway_error_page_is_transient(self, mock_post):
+        response = requests.Response()
+        response.status_code = 503
+        response.url = "https://test.url"
+        response._content = b"<html><body>503 Service Unavailable</body></html>"
+        mock_post.return_value = response
+        request = CorreosExpressRequest(self.carrier_correos_express)
+        request.breaker = CircuitBreaker()
+        result, error = request._fetch("POST", "https://test.url", {"test": "data"})
+        self.assertEqual(result, {})
+        self.assertIsInstance(error, requests.exceptions.HTTPError)
+        self.assertTrue(is_transient_error(error))
+
+    @mock.patch("requests.Session.post")
+    def test_14_find_shipment_only_not_found_is_unknown(self, mock_post):
+        """Only the not-found code means the reference is unknown: any other
+        code is an error, so the shipment is not registered again."""
+        request = CorreosExpressRequest(self.carrier_correos_express)
+        request.breaker = CircuitBreaker()
+        response = mock.Mock(status_code=200)
+        mock_post.return_value = response
+        response.json.return_value = {
+            "error": 1,
+            "mensajeError": "NO SE HAN ENCONTRADO DATOS",
+        }
+        self.assertEqual(request.find_shipment("REF"), (False, None))
+        response.json.return_value = {
+            "error": 2,
+            "mensajeError": "USUARIO NO AUTORIZADO",
+        }
+        tracking_number, error = request.find_shipment("REF")
+        self.assertFalse(tracking_number)
+        self.assertIsInstance(error, UserError)
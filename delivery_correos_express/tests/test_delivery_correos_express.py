@@ -3,12 +3,14 @@
 import time
 from unittest import mock
 
+import requests
+
 from odoo.tests import Form, common
 
-request_model = (
-    "odoo.addons.delivery_correos_express.models."
-    "correos_express_request.CorreosExpressRequest"
+request_module = (
+    "odoo.addons.delivery_correos_express.models.correos_express_request"
 )
+request_model = f"{request_module}.CorreosExpressRequest"
 
 # There is also no public test user so we mock all API requests
 
@@ -51,6 +53,14 @@ class TestCorreosExpressParcel(common.SingleTransactionCase):
         cls.picking = cls.sale_order.picking_ids[0]
         cls.picking.move_ids.quantity = 20
 
+    def setUp(self):
+        super().setUp()
+        # The circuit breakers live as long as the worker process: every test
+        # starts with closed ones, and the ones of the process are restored
+        patcher = mock.patch.dict(f"{request_module}._breakers", clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     @mock.patch(
         f"{request_model}.create_shipment",
         return_value={
@@ -122,3 +132,288 @@ class TestCorreosExpressParcel(common.SingleTransactionCase):
             self.picking
         )
         self.assertFalse(result)
+
+    @mock.patch("requests.Session.post")
+    def test_07_correos_express_send_shipping_concurrent(self, mock_post):
+        pickings = self.picking | self.picking.copy() | self.picking.copy()
+        failing_ref = pickings[1].name
+
+        def post(url, auth=None, json=None, timeout=None):
+            response = mock.Mock(status_code=200)
+            if json["ref"] == failing_ref:
+                response.json.return_value = {
+                    "codigoRetorno": 1,
+                    "mensajeRetorno": "Wrong zip",
+                }
+            else:
+                response.json.return_value = {
+                    "codigoRetorno": 0,
+                    "mensajeRetorno": "",
+                    "datosResultado": f"TRK-{json['ref']}",
+                }
+            return response
+
+        mock_post.side_effect = post
+        self.carrier_correos_express.correos_express_max_workers = 4
+        try:
+            result = self.carrier_correos_express.correos_express_send_shipping(
+                pickings
+            )
+        finally:
+            self.carrier_correos_express.correos_express_max_workers = 1
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual(
+            [vals["tracking_number"] for vals in result],
+            [f"TRK-{pickings[0].name}", False, f"TRK-{pickings[2].name}"],
+        )
+        self.assertIn("Wrong zip", pickings[1].message_ids[0].body)
+
+    @mock.patch("requests.Session.post")
+    def test_08_correos_express_queued_shipment_idempotent_retry(self, mock_post):
+        picking = self.picking.copy({"carrier_id": self.carrier_correos_express.id})
+        self.carrier_correos_express.correos_express_shipping_mode = "queue"
+        try:
+            result = self.carrier_correos_express.correos_express_send_shipping(
+                picking
+            )
+        finally:
+            self.carrier_correos_express.correos_express_shipping_mode = "sync"
+        self.assertFalse(result[0]["tracking_number"])
+        self.assertEqual(picking.correos_express_shipment_state, "pending")
+        mock_post.assert_not_called()
+
+        # The registration times out: the shipment stays pending
+        mock_post.side_effect = requests.exceptions.ConnectionError()
+        self.env["stock.picking"]._cron_correos_express_send_queued()
+        self.assertEqual(picking.correos_express_shipment_state, "pending")
+        self.assertEqual(picking.correos_express_shipment_attempts, 1)
+
+        # It did reach Correos Express: the retry finds it by reference
+        # instead of registering it again, and fetches its label
+        lookup = mock.Mock(status_code=200)
+        lookup.json.return_value = {
+            "error": 0,
+            "mensajeError": "",
+            "numEnvio": "0870000001",
+        }
+        label = mock.Mock(status_code=200)
+        label.json.return_value = {
+            "codErr": 0,
+            "desErr": "",
+            "listaEtiquetas": ["JVBERi0xLjQ="],
+        }
+        mock_post.side_effect = [lookup, label]
+        self.env["stock.picking"]._cron_correos_express_send_queued()
+        self.assertEqual(picking.correos_express_shipment_state, "sent")
+        self.assertEqual(picking.carrier_tracking_ref, "0870000001")
+        urls = [call.kwargs["url"] for call in mock_post.call_args_list]
+        self.assertEqual(len([url for url in urls if "grabacionEnvio" in url]), 1)
+
+    @mock.patch("requests.Session.post")
+    def test_09_correos_express_bulk_tracking(self, mock_post):
+        picking = self.picking.copy({"carrier_id": self.carrier_correos_express.id})
+        picking.write({"carrier_tracking_ref": "0870000002", "state": "done"})
+        events = [
+            {
+                "codEstado": "1",
+                "descEstado": "not received",
+                "horaEstado": "100240",
+                "fechaEstado": "09022021",
+            }
+        ]
+        tracking = mock.Mock(status_code=200)
+        tracking.json.side_effect = lambda: {
+            "error": 0,
+            "mensajeError": "",
+            "estadoEnvios": list(events),
+        }
+        mock_post.return_value = tracking
+        self.env["stock.picking"]._cron_correos_express_update_tracking()
+        self.assertEqual(
+            picking.tracking_state_history, "10:02:40 09/02/2021 - [1] not received"
+        )
+        self.assertTrue(picking.correos_express_next_tracking)
+
+        # Not due yet: no request
+        calls = mock_post.call_count
+        self.env["stock.picking"]._cron_correos_express_update_tracking()
+        self.assertEqual(mock_post.call_count, calls)
+
+        # Only the new event is added, and a final state closes the tracking
+        events.append(
+            {
+                "codEstado": "12",
+                "descEstado": "delivered",
+                "horaEstado": "091500",
+                "fechaEstado": "10022021",
+            }
+        )
+        picking.correos_express_next_tracking = False
+        self.env["stock.picking"]._cron_correos_express_update_tracking()
+        self.assertEqual(
+            picking.tracking_state_history,
+            "10:02:40 09/02/2021 - [1] not received\n"
+            "09:15:00 10/02/2021 - [12] delivered",
+        )
+        self.assertEqual(picking.tracking_state, "[12] delivered")
+        self.assertTrue(picking.correos_express_tracking_closed)
+        calls = mock_post.call_count
+        self.env["stock.picking"]._cron_correos_express_update_tracking()
+        self.assertEqual(mock_post.call_count, calls)
+
+    @mock.patch("requests.Session.post")
+    def test_10_correos_express_reconcile(self, mock_post):
+        delivered, unknown, unchanged = (
+            self.picking.copy({"carrier_id": self.carrier_correos_express.id})
+            for _i in range(3)
+        )
+        delivered.write({"carrier_tracking_ref": "0870000011", "state": "done"})
+        unknown.write({"carrier_tracking_ref": "0870000012", "state": "done"})
+        unchanged.write(
+            {
+                "carrier_tracking_ref": "0870000013",
+                "state": "done",
+                "correos_express_last_event": "202102091200003",
+            }
+        )
+
+        def post(url, auth=None, json=None, timeout=None):
+            response = mock.Mock(status_code=200)
+            if "listaEnvios" in url:
+                response.json.return_value = {
+                    "codError": "0",
+                    "desError": None,
+                    "listaEnvios": [
+                        {
+                            "nEnvio": "0870000011",
+                            "codigoEstado": "12",
+                            "descripcionEstado": "ENTREGADO",
+                            "fechaEstado": "2021-02-10 09:15:00.0",
+                            "codSeguimEnvio": "0",
+                        },
+                        {
+                            "nEnvio": "0870000012",
+                            "codSeguimEnvio": "1",
+                            "desSeguimEnvio": "KO",
+                        },
+                        {
+                            "nEnvio": "0870000013",
+                            "codigoEstado": "3",
+                            "descripcionEstado": "EN TRANSITO",
+                            "fechaEstado": "2021-02-09 12:00:00.0",
+                            "codSeguimEnvio": "0",
+                        },
+                    ],
+                }
+            else:
+                response.json.return_value = {
+                    "error": 0,
+                    "mensajeError": "",
+                    "estadoEnvios": [
+                        {
+                            "codEstado": "3",
+                            "descEstado": "in transit",
+                            "horaEstado": "120000",
+                            "fechaEstado": "09022021",
+                        },
+                        {
+                            "codEstado": "12",
+                            "descEstado": "ENTREGADO",
+                            "horaEstado": "091500",
+                            "fechaEstado": "10022021",
+                        },
+                    ],
+                }
+            return response
+
+        mock_post.side_effect = post
+        tracked = self.carrier_correos_express._correos_express_reconcile(
+            delivered | unknown | unchanged
+        )
+        # The intermediate events of the delivered shipment are not lost
+        self.assertEqual(tracked, delivered | unknown)
+        self.assertEqual(delivered.tracking_state, "[12] ENTREGADO")
+        self.assertEqual(
+            delivered.tracking_state_history,
+            "12:00:00 09/02/2021 - [3] in transit\n"
+            "09:15:00 10/02/2021 - [12] ENTREGADO",
+        )
+        self.assertTrue(delivered.correos_express_tracking_closed)
+        self.assertEqual(unknown.tracking_state, "[12] ENTREGADO")
+        self.assertFalse(unchanged.tracking_state_history)
+        self.assertFalse(unchanged.correos_express_tracking_closed)
+        self.assertTrue(unchanged.correos_express_next_tracking)
+        urls = [call.kwargs["url"] for call in mock_post.call_args_list]
+        self.assertEqual(len([url for url in urls if "listaEnvios" in url]), 1)
+        self.assertEqual(len([url for url in urls if "seguimientoEnvio" in url]), 2)
+
+    @mock.patch("requests.Session.post")
+    def test_11_correos_express_queued_shipment_interrupted(self, mock_post):
+        """The worker dies after the registration reached Correos Express
+        but before its result was committed: the next run finds it by
+        reference instead of registering it again."""
+
+        class WorkerKilled(BaseException):
+            pass
+
+        picking = self.picking.copy({"carrier_id": self.carrier_correos_express.id})
+        picking._correos_express_queue_shipment()
+        mock_post.side_effect = WorkerKilled()
+        with self.assertRaises(WorkerKilled):
+            self.env["stock.picking"]._cron_correos_express_send_queued()
+        self.assertEqual(picking.correos_express_shipment_attempts, 1)
+
+        lookup = mock.Mock(status_code=200)
+        lookup.json.return_value = {
+            "error": 0,
+            "mensajeError": "",
+            "numEnvio": "0870000003",
+        }
+        label = mock.Mock(status_code=200)
+        label.json.return_value = {
+            "codErr": 0,
+            "desErr": "",
+            "listaEtiquetas": ["JVBERi0xLjQ="],
+        }
+        mock_post.side_effect = [lookup, label]
+        self.env["stock.picking"]._cron_correos_express_send_queued()
+        self.assertEqual(picking.correos_express_shipment_state, "sent")
+        self.assertEqual(picking.carrier_tracking_ref, "0870000003")
+        urls = [call.kwargs["url"] for call in mock_post.call_args_list]
+        self.assertEqual(len([url for url in urls if "grabacionEnvio" in url]), 1)
+
+    @mock.patch(
+        f"{request_model}.track_shipment",
+        return_value={
+            "estadoEnvios": [
+                {
+                    "codEstado": "1",
+                    "descEstado": "not received",
+                    "horaEstado": "100240",
+                    "fechaEstado": "09022021",
+                },
+                {
+                    "codEstado": "3",
+                    "descEstado": "in transit",
+                    "horaEstado": "120000",
+                    "fechaEstado": "10022021",
+                },
+            ]
+        },
+    )
+    def test_12_correos_express_tracking_existing_history(self, redirect_mock):
+        """Pickings tracked before the last event key was stored already have
+        a history: it is rebuilt instead of getting the events twice."""
+        self.picking.write(
+            {
+                "tracking_state_history": "10:02:40 09/02/2021 - [1] not received",
+                "correos_express_last_event": False,
+            }
+        )
+        self.picking.tracking_state_update()
+        self.assertEqual(
+            self.picking.tracking_state_history,
+            "10:02:40 09/02/2021 - [1] not received\n"
+            "12:00:00 10/02/2021 - [3] in transit",
+        )
+        self.assertEqual(self.picking.correos_express_last_event, "202102101200003")
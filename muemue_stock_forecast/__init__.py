@@ -1 +1,6 @@
-from . import models
\ No newline at end of file
+from . import models
+
+
+def post_init_hook(env):
+    # Carga inicial del histórico mensual con los pedidos ya existentes
+    env['stock.forecast.sales.month']._rebuild()
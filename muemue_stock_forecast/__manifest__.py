@@ -1,6 +1,6 @@
 {
     'name': 'Muemue Stock Forecast',
-    'version': '17.0',
+    'version': '17.0.17.2',
     'summary': 'Previsión de stock para Muemue',
     'description': """
         Módulo para calcular la previsión de stock basado en ventas históricas
@@ -9,14 +9,20 @@
     'author': 'ESSEDI IT CONSULTING SL',
     'website': 'https://www.essedi.es',
     'depends': ['base','stock', 'sale', 'product','purchase'],
+    'external_dependencies': {'python': ['numpy']},
     'data': [
         'security/ir.model.access.csv',
+        'data/ir_config_parameter_data.xml',
+        'data/ir_cron_data.xml',
         'views/stock_order_wizard_views.xml',
+        'views/stock_forecast_wizard_views.xml',
         'views/stock_forecast_views.xml',
         'views/product_template_views.xml',
+        'views/stock_forecast_refresh_log_views.xml',
         
     ],
     'demo': [],
+    'post_init_hook': 'post_init_hook',
     'installable': True,
     'application': True,
     'auto_install': False,
@@ -0,0 +1,10 @@
+from odoo import SUPERUSER_ID, api
+
+
+def migrate(cr, version):
+    # En instalaciones nuevas el histórico lo carga el post_init_hook
+    if not version:
+        return
+    # Carga del histórico mensual en bases que ya tenían el módulo instalado
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    env['stock.forecast.sales.month']._rebuild()
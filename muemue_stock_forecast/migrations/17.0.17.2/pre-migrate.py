@@ -0,0 +1,7 @@
+def migrate(cr, version):
+    # Los albaranes validados se registran ahora como movimientos realizados
+    cr.execute("""
+        UPDATE stock_forecast_refresh_log
+           SET trigger = 'move_done'
+         WHERE trigger = 'picking_validate'
+    """)
@@ -1,6 +1,14 @@
 from . import stock_forecast
+from . import stock_forecast_sales_month
+from . import stock_forecast_refresh_queue
+from . import stock_forecast_warehouse
+from . import stock_forecast_refresh_log
+from . import stock_forecast_reorder_request
 from . import stock_order_wizard
+from . import stock_forecast_wizard
+from . import product_product
 from . import product_template
 from . import purchase_order
 from . import sale_order
-from . import stock_picking
\ No newline at end of file
+from . import sale_order_line
+from . import stock_move
\ No newline at end of file
@@ -0,0 +1,85 @@
+"""
+Modelos de demanda vectorizados para la previsión de stock.
+
+Todas las funciones reciben la matriz de demanda mensual (productos x meses,
+del mes más antiguo al más reciente, solo meses completos) y devuelven un
+array con la demanda prevista para el próximo mes de cada producto.
+Cada pasada trabaja sobre todos los productos a la vez; los únicos bucles
+son sobre los meses, que son pocos.
+"""
+import numpy as np
+
+# Parámetros de suavizado
+ALPHA = 0.3     # nivel
+BETA = 0.1      # tendencia
+GAMMA = 0.2     # estacionalidad
+SEASON_LENGTH = 12
+
+# Meses de historial que se cargan como mínimo: Holt-Winters necesita
+# dos temporadas completas para inicializarse.
+HISTORY_MONTHS = 2 * SEASON_LENGTH
+
+
+def simple_average(matrix, window):
+    """Media de los últimos 'window' meses."""
+    window = max(1, min(window, matrix.shape[1]))
+    return matrix[:, -window:].mean(axis=1)
+
+
+def weighted_moving_average(matrix, window):
+    """Media móvil con pesos lineales: el mes más reciente pesa 'window'."""
+    window = max(1, min(window, matrix.shape[1]))
+    weights = np.arange(1, window + 1, dtype=float)
+    return matrix[:, -window:] @ weights / weights.sum()
+
+
+def exponential_smoothing(matrix, window=None, alpha=ALPHA):
+    """Suavizado exponencial simple sobre todo el historial cargado."""
+    level = matrix[:, 0].astype(float)
+    for month in range(1, matrix.shape[1]):
+        level = alpha * matrix[:, month] + (1 - alpha) * level
+    return level
+
+
+def holt_winters(matrix, window=None, alpha=ALPHA, beta=BETA, gamma=GAMMA, season=SEASON_LENGTH):
+    """
+    Holt-Winters aditivo (nivel, tendencia y estacionalidad).
+    Con menos de dos temporadas de historial se usa el suavizado exponencial.
+    """
+    n_months = matrix.shape[1]
+    if n_months < 2 * season:
+        return exponential_smoothing(matrix, alpha=alpha)
+
+    first = matrix[:, :season].mean(axis=1)
+    second = matrix[:, season:2 * season].mean(axis=1)
+    level = first
+    trend = (second - first) / season
+    seasonal = matrix[:, :season] - first[:, None]
+
+    for month in range(season, n_months):
+        value = matrix[:, month]
+        season_index = month % season
+        previous_level = level
+        level = alpha * (value - seasonal[:, season_index]) + (1 - alpha) * (level + trend)
+        trend = beta * (level - previous_level) + (1 - beta) * trend
+        seasonal[:, season_index] = gamma * (value - level) + (1 - gamma) * seasonal[:, season_index]
+
+    return level + trend + seasonal[:, n_months % season]
+
+
+DEMAND_MODELS = {
+    'weighted': weighted_moving_average,
+    'exponential': exponential_smoothing,
+    'holt_winters': holt_winters,
+}
+
+
+def forecast(model, matrix, window):
+    """
+    Aplica el modelo 'model' a la matriz y devuelve la demanda prevista,
+    sin valores negativos.
+    """
+    if not matrix.shape[0]:
+        return np.zeros(0)
+    demand_model = DEMAND_MODELS.get(model, simple_average)
+    return np.clip(demand_model(matrix, window), 0, None)
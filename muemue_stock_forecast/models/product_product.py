@@ -0,0 +1,10 @@
+from odoo import models, fields
+
+class ProductProduct(models.Model):
+    _inherit = 'product.product'
+
+    forecast_ids = fields.One2many(
+        'stock.forecast',
+        'product_id',
+        string="Líneas de Previsión"
+    )
@@ -1,4 +1,4 @@
-from odoo import models,api
+from odoo import models
 
 class PurchaseOrder(models.Model):
     _inherit='purchase.order'
@@ -6,13 +6,6 @@ class PurchaseOrder(models.Model):
     def button_confirm(self):
         res=super(PurchaseOrder,self).button_confirm()
 
-        for order in self:
-            product_ids=order.order_line.mapped('product_id').ids
-
-            if product_ids:
-                forecasts=self.env['stock.forecast'].search([('product_id','in',product_ids)])
-
-                if forecasts:
-                    forecasts.action_refresh_stock_data()
+        self.env['stock.forecast']._schedule_refresh(self.order_line.product_id.ids, 'po_confirm', ('incoming',))
         
         return res
\ No newline at end of file
@@ -1,21 +1,39 @@
-from odoo import models, api
+from odoo import models
 
 class SaleOrder(models.Model):
     _inherit='sale.order'
 
+    def write(self, vals):
+        # Cambiar la fecha o la compañía de un pedido ya confirmado lo mueve
+        # de mes en el histórico. Confirmar y cancelar (que también escriben
+        # date_order) lo suman y restan en action_confirm y _action_cancel.
+        if 'state' in vals or not ('date_order' in vals or 'company_id' in vals):
+            return super(SaleOrder, self).write(vals)
+        confirmed_orders = self.filtered(lambda o: o.state in ('sale', 'done'))
+        sales_month = self.env['stock.forecast.sales.month'].sudo()
+        sales_month._add_orders(confirmed_orders, sign=-1)
+        res = super(SaleOrder, self).write(vals)
+        sales_month._add_orders(confirmed_orders)
+        self.env['stock.forecast']._schedule_refresh(
+            confirmed_orders.order_line.product_id.ids, 'sale_update', ('sales',))
+        return res
+
     def action_confirm(self):
         res = super(SaleOrder, self).action_confirm()
-    
-        for order in self:
-            product_ids = order.order_line.mapped('product_id').ids
-            
-            if product_ids:
-                forecasts = self.env['stock.forecast'].search([
-                    ('product_id', 'in', product_ids)
-                ])
-                
-               
-                if forecasts:
-                    forecasts.action_refresh_stock_data()
+
+        # Mantiene al día el histórico mensual y suma las cantidades a la previsión
+        self.env['stock.forecast.sales.month'].sudo()._add_orders(self)
+        self.env['stock.forecast']._apply_sales_delta(self, 1, 'sale_confirm')
                     
         return res
+
+    def _action_cancel(self):
+        # Solo los pedidos confirmados están sumados en el histórico y en la previsión
+        confirmed_orders = self.filtered(lambda o: o.state in ('sale', 'done'))
+        res = super(SaleOrder, self)._action_cancel()
+
+        if confirmed_orders:
+            self.env['stock.forecast.sales.month'].sudo()._add_orders(confirmed_orders, sign=-1)
+            self.env['stock.forecast']._apply_sales_delta(confirmed_orders, -1, 'sale_cancel')
+
+        return res
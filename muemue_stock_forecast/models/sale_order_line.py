@@ -0,0 +1,45 @@
+from odoo import models, api
+
+# Campos de la línea que cuentan en el histórico mensual de ventas
+SALES_HISTORY_FIELDS = ('order_id', 'product_id', 'product_uom_qty')
+
+
+class SaleOrderLine(models.Model):
+    _inherit = 'sale.order.line'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        lines = super().create(vals_list)
+        confirmed_lines = lines._filter_confirmed()
+        if confirmed_lines:
+            self.env['stock.forecast.sales.month'].sudo()._add_order_lines(confirmed_lines)
+            confirmed_lines._schedule_sales_refresh()
+        return lines
+
+    def write(self, vals):
+        if not any(fname in vals for fname in SALES_HISTORY_FIELDS):
+            return super().write(vals)
+        # Se resta lo que contaba antes del cambio y se suma lo que cuenta después
+        sales_month = self.env['stock.forecast.sales.month'].sudo()
+        confirmed_before = self._filter_confirmed()
+        sales_month._add_order_lines(confirmed_before, sign=-1)
+        product_ids = set(confirmed_before.product_id.ids)
+        res = super().write(vals)
+        confirmed_after = self._filter_confirmed()
+        sales_month._add_order_lines(confirmed_after)
+        product_ids.update(confirmed_after.product_id.ids)
+        self.env['stock.forecast']._schedule_refresh(list(product_ids), 'sale_update', ('sales',))
+        return res
+
+    def unlink(self):
+        confirmed_lines = self._filter_confirmed()
+        if confirmed_lines:
+            self.env['stock.forecast.sales.month'].sudo()._add_order_lines(confirmed_lines, sign=-1)
+            confirmed_lines._schedule_sales_refresh()
+        return super().unlink()
+
+    def _filter_confirmed(self):
+        return self.filtered(lambda line: line.order_id.state in ('sale', 'done') and line.product_id)
+
+    def _schedule_sales_refresh(self):
+        self.env['stock.forecast']._schedule_refresh(self.product_id.ids, 'sale_update', ('sales',))
@@ -1,11 +1,55 @@
 import math
+import time
 from odoo import models, fields, api, _ 
+from odoo.modules.registry import Registry
+from odoo.tools import SQL, create_index, frozendict
 from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
 from collections import defaultdict
 from odoo.exceptions import UserError 
+import numpy as np
+from . import forecast_engine
+from .supplier_price_resolver import SupplierPriceResolver
 import logging
 _logger = logging.getLogger(__name__)
 
+# Índices que mantiene el módulo para las consultas de la previsión:
+# (nombre, tabla, columnas, condición del índice parcial)
+FORECAST_INDEXES = [
+    ('muemue_sale_order_line_product_order_idx', 'sale_order_line',
+     ['product_id', 'order_id'], ''),
+    ('muemue_sale_order_confirmed_date_idx', 'sale_order',
+     ['date_order'], "state IN ('sale', 'done')"),
+    ('muemue_stock_move_open_product_idx', 'stock_move',
+     ['product_id', 'picking_id'], "state IN ('assigned', 'confirmed', 'waiting', 'partially_available')"),
+    ('muemue_stock_picking_open_scheduled_date_idx', 'stock_picking',
+     ['scheduled_date'], "state NOT IN ('draft', 'done', 'cancel')"),
+]
+
+# Componentes que se pueden recalcular por separado, en orden de cálculo
+REFRESH_COMPONENTS = ('current', 'incoming', 'sales')
+
+# Celdas (líneas x días) como mucho de cada matriz de la proyección: con
+# horizontes de un año, unas 2.700 líneas por bloque y ~22 MB por matriz
+PROJECTION_CHUNK_CELLS = 1000000
+
+# Campos de la proyección, que usan la fecha prevista de cada entrada y no
+# solo el total entrante: se recalculan siempre que se recalcula el entrante
+PROJECTION_FIELDS = ('projected_stockout_date', 'min_projected_stock')
+
+# Campos guardados que dependen de la fecha de hoy (la matriz mensual de la
+# demanda avanza cada mes y la proyección se mide desde hoy), junto con la
+# cobertura que depende de ellos. Sus entradas pueden no cambiar, así que el
+# recálculo manual y el nocturno los fuerzan.
+DATED_FIELDS = (
+    'forecast_demand', 'projected_stockout_date', 'min_projected_stock',
+    'total_available_stock', 'coverage_months', 'need_reorder', 'reorder_warning',
+)
+
+# Clave de cr.precommit.data donde se acumulan los productos de los
+# movimientos hechos en la transacción
+DONE_MOVES_KEY = 'muemue_stock_forecast.done_moves'
+
 class StockForecast(models.Model):
     _name = 'stock.forecast'
     _description = 'Previsión de Stock'
@@ -23,8 +67,18 @@ class StockForecast(models.Model):
     ]
 
     
-    default_code = fields.Char(string="Referencia", related='product_id.default_code')
-    product_name = fields.Char(string="Descripción", related='product_id.name')
+    # Copias guardadas e indexadas para buscar y ordenar sin unir
+    # product_product ni los nombres traducidos de product_template
+    default_code = fields.Char(string="Referencia", related='product_id.default_code', store=True, index='trigram')
+    product_name = fields.Char(string="Descripción", related='product_id.name', store=True, index='trigram')
+    main_supplier_id = fields.Many2one(
+        'res.partner',
+        string="Proveedor Principal",
+        compute='_compute_main_supplier_id',
+        store=True,
+        index=True,
+        help="Proveedor que Odoo elegiría por defecto para el producto (primera tarifa válida)."
+    )
 
     
     months_history = fields.Integer(
@@ -46,6 +100,13 @@ class StockForecast(models.Model):
         help="Stock actual en ubicaciones internas.",
         store=True
     )
+    warehouse_stock_ids = fields.One2many(
+        'stock.forecast.warehouse',
+        'forecast_id',
+        string="Stock por Almacén",
+        readonly=True,
+        help="Desglose del Stock Mano por almacén, guardado al recalcular."
+    )
     incoming_stock = fields.Float(
         compute='_compute_incoming_stock', 
         string="Stock Entrante",
@@ -67,6 +128,26 @@ class StockForecast(models.Model):
         store =True
     )
 
+    forecast_model = fields.Selection(
+        [
+            ('average', 'Media Simple'),
+            ('weighted', 'Media Ponderada'),
+            ('exponential', 'Suavizado Exponencial'),
+            ('holt_winters', 'Holt-Winters (Estacional)'),
+        ],
+        string="Modelo Demanda",
+        default='average',
+        required=True,
+        help="Modelo usado para prever la demanda mensual. 'Media Simple' equivale a la Media Mes."
+    )
+    forecast_demand = fields.Float(
+        compute='_compute_forecast_demand',
+        string="Demanda Prevista",
+        digits=(12, 2),
+        help="Demanda mensual prevista según el modelo elegido. Es la que se usa para la cobertura.",
+        store=True
+    )
+
     
     total_available_stock = fields.Float(
         compute='_compute_coverage_data',
@@ -80,6 +161,18 @@ class StockForecast(models.Model):
         digits=(12, 2),
         store=True
     )
+    projected_stockout_date = fields.Date(
+        compute='_compute_projection',
+        string="Fecha Rotura",
+        help="Primer día en que el stock proyectado (stock a mano + entradas en su fecha - demanda diaria) llega a cero.",
+        store=True
+    )
+    min_projected_stock = fields.Float(
+        compute='_compute_projection',
+        string="Stock Mínimo Proyectado",
+        help="Stock más bajo de la proyección diaria dentro del periodo de previsión.",
+        store=True
+    )
     need_reorder = fields.Boolean(
         compute='_compute_coverage_data', 
         store=True
@@ -92,15 +185,103 @@ class StockForecast(models.Model):
 
 
     
-    @api.depends('current_stock', 'incoming_stock', 'monthly_average', 'forecast_months')
+    @api.depends(
+        'product_id.product_tmpl_id.seller_ids.partner_id',
+        'product_id.product_tmpl_id.seller_ids.partner_id.active',
+        'product_id.product_tmpl_id.seller_ids.sequence',
+        'product_id.product_tmpl_id.seller_ids.min_qty',
+        'product_id.product_tmpl_id.seller_ids.price',
+        'product_id.product_tmpl_id.seller_ids.product_id',
+        'product_id.product_tmpl_id.seller_ids.company_id',
+        'product_id.product_tmpl_id.seller_ids.date_start',
+        'product_id.product_tmpl_id.seller_ids.date_end',
+    )
+    def _compute_main_supplier_id(self):
+        # Las fechas de validez se evalúan al recalcular; el recálculo
+        # completo nocturno recoge las tarifas que caducan o entran en vigor
+        price_resolver = SupplierPriceResolver(self.env, self.product_id)
+        for rec in self:
+            rec.main_supplier_id = price_resolver.select_seller(rec.product_id).partner_id
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        forecasts = super().create(vals_list)
+        # El desglose por almacén no es un campo calculado: se escribe al crear
+        # la línea y en cada recálculo del stock actual
+        forecasts._update_warehouse_stock(forecasts._get_stock_by_warehouse())
+        return forecasts
+
+    def init(self):
+        for index_name, table, columns, where in FORECAST_INDEXES:
+            create_index(self.env.cr, index_name, table, columns, where=where)
+
+    @api.model
+    def _check_forecast_query_plans(self, limit=100):
+        """
+        Lanza EXPLAIN sobre las consultas de la previsión (ventas del mes
+        parcial y stock entrante) para una muestra de 'limit' líneas y
+        devuelve {consulta: [índices del módulo que usa el plan]}.
+        """
+        forecasts = self.sudo().search([], limit=limit)
+        product_ids = forecasts.product_id.ids or [0]
+        now = datetime.now()
+        queries = {
+            'ventas': self.env['sale.order.line'].sudo()._search([
+                ('order_id.date_order', '>=', now - timedelta(days=30)),
+                ('order_id.date_order', '<', now),
+                ('order_id.state', 'in', ['sale', 'done']),
+                ('product_id', 'in', product_ids)
+            ]),
+            'entrante': self.env['stock.move'].sudo()._search(
+                [('product_id', 'in', product_ids)] + self._get_incoming_stock_period_domain(3)
+            ),
+        }
+        module_indexes = {index_name for index_name, _table, _columns, _where in FORECAST_INDEXES}
+
+        def collect_indexes(plan, found):
+            if plan.get('Index Name') in module_indexes:
+                found.add(plan['Index Name'])
+            for subplan in plan.get('Plans', []):
+                collect_indexes(subplan, found)
+            return found
+
+        result = {}
+        for name, query in queries.items():
+            self.env.cr.execute(SQL("EXPLAIN (FORMAT JSON) %s", query.select()))
+            plan = self.env.cr.fetchone()[0][0]['Plan']
+            result[name] = sorted(collect_indexes(plan, set()))
+            _logger.info("Plan de la consulta '%s': índices del módulo usados %s", name, result[name])
+        return result
+
+    def action_check_query_plans(self):
+        """
+        Muestra qué índices del módulo usan las consultas de la previsión.
+        """
+        result = self._check_forecast_query_plans()
+        message = "\n".join(
+            f"{name}: {', '.join(indexes) if indexes else _('ningún índice del módulo')}"
+            for name, indexes in result.items()
+        )
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Planes de Consulta'),
+                'message': message,
+                'type': 'info' if all(result.values()) else 'warning',
+                'sticky': True,
+            },
+        }
+
+    @api.depends('current_stock', 'incoming_stock', 'forecast_demand', 'forecast_months')
     def _compute_coverage_data(self):
         """
         Calcula la cobertura y la necesidad de pedido.
         """
         for rec in self:
             rec.total_available_stock = rec.current_stock + rec.incoming_stock
-            if rec.monthly_average > 0:
-                rec.coverage_months = rec.total_available_stock / rec.monthly_average
+            if rec.forecast_demand > 0:
+                rec.coverage_months = rec.total_available_stock / rec.forecast_demand
             else:
                 rec.coverage_months = 999 if rec.total_available_stock > 0 else 0
 
@@ -110,31 +291,183 @@ class StockForecast(models.Model):
             rec.reorder_warning = (rec.coverage_months > rec.forecast_months) and (rec.coverage_months <= warning_limit)
 
 
+    @api.depends('current_stock', 'incoming_stock', 'forecast_demand', 'forecast_months')
+    def _compute_projection(self):
+        """
+        Proyecta el stock día a día durante el periodo de previsión: parte del
+        stock a mano, suma cada entrada en la fecha prevista de su albarán y
+        resta la demanda diaria. Se calcula con una matriz (líneas x días) por
+        bloques de líneas, para no reservar de golpe memoria para todo el
+        recordset, y con una sola lectura de las entradas.
+        """
+        incoming_by_day = self._get_incoming_stock_by_day()
+        max_days = max((rec._get_projection_days() for rec in self), default=0)
+        chunk_size = max(1, PROJECTION_CHUNK_CELLS // max(max_days, 1))
+        for start in range(0, len(self), chunk_size):
+            self[start:start + chunk_size]._set_projection(incoming_by_day)
+
+    def _get_projection_days(self):
+        """Días del periodo de previsión de la línea."""
+        self.ensure_one()
+        return math.ceil(self.forecast_months * 30.44) if self.forecast_months > 0 else 0
+
+    def _set_projection(self, incoming_by_day):
+        """
+        Asigna la proyección de un bloque de líneas, con las entradas por día
+        de _get_incoming_stock_by_day.
+        """
+        today = fields.Date.today()
+        horizons = np.array([rec._get_projection_days() for rec in self], dtype=int)
+        n_days = int(horizons.max()) if len(self) else 0
+        if not n_days:
+            for rec in self:
+                rec.min_projected_stock = rec.current_stock
+                rec.projected_stockout_date = False
+            return
+
+        incoming = np.zeros((len(self), n_days))
+        for row, rec in enumerate(self):
+            for day, qty in incoming_by_day.get(rec.id, []):
+                incoming[row, min(max(day, 0), n_days - 1)] += qty
+
+        current = np.array([rec.current_stock for rec in self])
+        daily_demand = np.array([rec.forecast_demand for rec in self]) / 30.44
+        days = np.arange(1, n_days + 1)
+        projected = current[:, None] + np.cumsum(incoming, axis=1) - daily_demand[:, None] * days
+
+        # Los días fuera del horizonte de cada línea no cuentan
+        outside = days[None, :] > horizons[:, None]
+        min_stock = np.where(outside, np.inf, projected).min(axis=1)
+        stockout = (projected <= 0) & ~outside & (daily_demand[:, None] > 0)
+        has_stockout = stockout.any(axis=1)
+        first_stockout = stockout.argmax(axis=1)
+
+        for row, rec in enumerate(self):
+            if not horizons[row]:
+                rec.min_projected_stock = rec.current_stock
+                rec.projected_stockout_date = False
+                continue
+            rec.min_projected_stock = float(min_stock[row])
+            rec.projected_stockout_date = (
+                today + timedelta(days=int(first_stockout[row])) if has_stockout[row] else False
+            )
+
+    def _get_incoming_stock_by_day(self):
+        """
+        Devuelve {id de previsión: [(día, cantidad), ...]} con las entradas del
+        periodo de previsión, donde 'día' es el número de días desde hoy hasta
+        la fecha prevista del albarán. Una consulta por horizonte distinto.
+        """
+        today = fields.Date.today()
+        product_ids_by_horizon = defaultdict(list)
+        for rec in self:
+            if rec.product_id and rec.forecast_months > 0:
+                product_ids_by_horizon[rec.forecast_months].append(rec.product_id.id)
+
+        incoming_by_horizon = {}
+        for forecast_months, product_ids in product_ids_by_horizon.items():
+            domain = [('product_id', 'in', product_ids)] + self._get_incoming_stock_period_domain(forecast_months)
+            groups = self.env['stock.move']._read_group(domain, ['product_id', 'picking_id'], ['product_uom_qty:sum'])
+            moves_by_product = defaultdict(list)
+            for product, picking, qty in groups:
+                day = (fields.Date.to_date(picking.scheduled_date) - today).days
+                moves_by_product[product.id].append((day, qty))
+            incoming_by_horizon[forecast_months] = moves_by_product
+
+        return {
+            rec.id: incoming_by_horizon.get(rec.forecast_months, {}).get(rec.product_id.id, [])
+            for rec in self
+        }
+
     @api.depends('product_id')
     def _compute_current_stock(self):
         """
         Calcula el stock actual (a mano).
         """
-        if not self.product_id:
-            self.current_stock = 0
-            return
-        quants = self.env['stock.quant'].search_read([
-            ('product_id', 'in', self.product_id.ids),
-            ('location_id.usage', '=', 'internal')
-        ], ['product_id', 'quantity'])
-        current_stock_map = defaultdict(float)
-        for quant in quants:
-            current_stock_map[quant['product_id'][0]] += quant['quantity']
+        values = self._get_current_values()
         for rec in self:
-            rec.current_stock = current_stock_map.get(rec.product_id.id, 0)
+            rec.update(values[rec.id])
+
+    def _get_current_values(self, stock_rows=None):
+        """
+        Devuelve {id de previsión: {'current_stock': ...}} a partir de las
+        filas de _get_stock_by_warehouse (que se leen si no se pasan). No
+        toca el desglose por almacén: lo escribe _update_warehouse_stock.
+        """
+        if stock_rows is None:
+            stock_rows = self._get_stock_by_warehouse()
+        current_stock_map = defaultdict(float)
+        for product_id, _warehouse_id, quantity in stock_rows:
+            current_stock_map[product_id] += quantity
+        return {rec.id: {'current_stock': current_stock_map.get(rec.product_id.id, 0)} for rec in self}
+
+    def _get_stock_by_warehouse(self):
+        """
+        Devuelve [(product_id, warehouse_id, cantidad)] de las ubicaciones
+        internas, agregado en base de datos (SUM ... GROUP BY producto,
+        almacén) en lugar de leer cada quant. warehouse_id es None para las
+        ubicaciones internas que no cuelgan de ningún almacén.
+        """
+        product_ids = self.product_id.ids
+        if not product_ids:
+            return []
+        self.env['stock.quant'].flush_model(['product_id', 'location_id', 'quantity'])
+        self.env['stock.location'].flush_model(['usage', 'warehouse_id'])
+        # _search aplica las reglas de registro igual que el search_read anterior
+        query = self.env['stock.quant']._search([
+            ('product_id', 'in', product_ids),
+            ('location_id.usage', '=', 'internal')
+        ])
+        quant_sql = query.select(
+            SQL.identifier(query.table, 'product_id'),
+            SQL("(SELECT loc.warehouse_id FROM stock_location loc WHERE loc.id = %s) AS warehouse_id",
+                SQL.identifier(query.table, 'location_id')),
+            SQL.identifier(query.table, 'quantity'),
+        )
+        self.env.cr.execute(SQL("""
+            SELECT product_id, warehouse_id, SUM(quantity)
+              FROM (%s) quant
+          GROUP BY product_id, warehouse_id
+        """, quant_sql))
+        return self.env.cr.fetchall()
+
+    def _update_warehouse_stock(self, stock_rows):
+        """
+        Sustituye el desglose por almacén de las líneas guardadas con las
+        filas de _get_stock_by_warehouse, con un DELETE y un INSERT. Lo
+        llaman _refresh_stock_data y la creación de líneas, nunca el compute.
+        """
+        forecast_by_product = {
+            rec.product_id.id: rec.id for rec in self if rec.product_id and isinstance(rec.id, int)
+        }
+        if not forecast_by_product:
+            return
+        rows = [
+            (forecast_by_product[product_id], warehouse_id, quantity)
+            for product_id, warehouse_id, quantity in stock_rows
+            if warehouse_id and product_id in forecast_by_product
+        ]
+        self.env.cr.execute(SQL(
+            "DELETE FROM stock_forecast_warehouse WHERE forecast_id = ANY(%s)",
+            list(forecast_by_product.values()),
+        ))
+        if rows:
+            forecast_ids, warehouse_ids, quantities = zip(*rows)
+            self.env.cr.execute(SQL("""
+                INSERT INTO stock_forecast_warehouse (forecast_id, warehouse_id, quantity)
+                     SELECT * FROM unnest(%s::int[], %s::int[], %s::float8[])
+            """, list(forecast_ids), list(warehouse_ids), list(quantities)))
+        self.env['stock.forecast.warehouse'].invalidate_model()
+        self.invalidate_recordset(['warehouse_stock_ids'])
     
     
     
     def _get_incoming_stock_domain(self):
         """
         Función auxiliar que CONSTRUYE el dominio (filtro) para el stock entrante.
-        Es usada tanto por _compute_incoming_stock como por action_view_incoming_stock_moves
-        para asegurar que la lógica es idéntica.
+        Es usada por action_view_incoming_stock_moves y comparte con el cálculo
+        masivo (_get_incoming_stock_totals) el filtro de periodo, para asegurar
+        que la lógica es idéntica.
         """
         
         self.ensure_one()
@@ -143,16 +476,24 @@ class StockForecast(models.Model):
             
             return [('id', '=', 0)]
 
+        return [('product_id', '=', self.product_id.id)] + self._get_incoming_stock_period_domain(self.forecast_months)
+
+    @api.model
+    def _get_incoming_stock_period_domain(self, forecast_months):
+        """
+        Parte del dominio de stock entrante que no depende del producto, solo
+        del horizonte de previsión. La comparten el dominio por línea y el
+        cálculo masivo.
+        """
         # 1. Fecha de inicio: HOY a las 00:00:00
         start_dt = fields.Datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
 
         # 2. Fecha de fin: La fecha de hoy + X meses
-        end_date = fields.Date.today() + timedelta(days=self.forecast_months * 30.44)
+        end_date = fields.Date.today() + timedelta(days=forecast_months * 30.44)
         # 3. Convertir a datetime de FIN del día (23:59:59)
         end_dt = fields.Datetime.to_datetime(end_date).replace(hour=23, minute=59, second=59)
         
         domain = [
-            ('product_id', '=', self.product_id.id),
             ('state', 'in', ['assigned', 'confirmed', 'waiting', 'partially_available']),
             ('picking_type_id.code', '=', 'incoming'),
             
@@ -170,44 +511,146 @@ class StockForecast(models.Model):
         """
         Calcula el stock entrante basado en los 'forecast_months'.
         """
+        values = self._get_incoming_values()
         for rec in self:
-            
-            domain = rec._get_incoming_stock_domain()
-            
-            if domain == [('id', '=', 0)]:
-                rec.incoming_stock = 0
-                continue
-                
-            incoming_moves = self.env['stock.move'].search_read(domain, ['product_uom_qty'])
-            rec.incoming_stock = sum(move['product_uom_qty'] for move in incoming_moves)
+            rec.update(values[rec.id])
+
+    def _get_incoming_values(self):
+        incoming_map = self._get_incoming_stock_totals()
+        return {rec.id: {'incoming_stock': incoming_map.get(rec.id, 0.0)} for rec in self}
+
+    def _get_incoming_stock_totals(self):
+        """
+        Devuelve {id de previsión: cantidad entrante} para todo el recordset.
+        Agrupa las líneas por 'forecast_months' y lanza una sola consulta
+        agregada sobre stock.move por cada horizonte distinto.
+        """
+        product_ids_by_horizon = defaultdict(list)
+        for rec in self:
+            if rec.product_id and rec.forecast_months > 0:
+                product_ids_by_horizon[rec.forecast_months].append(rec.product_id.id)
+
+        incoming_by_horizon = {}
+        for forecast_months, product_ids in product_ids_by_horizon.items():
+            domain = [('product_id', 'in', product_ids)] + self._get_incoming_stock_period_domain(forecast_months)
+            groups = self.env['stock.move']._read_group(domain, ['product_id'], ['product_uom_qty:sum'])
+            incoming_by_horizon[forecast_months] = {product.id: qty for product, qty in groups}
+
+        return {
+            rec.id: incoming_by_horizon.get(rec.forecast_months, {}).get(rec.product_id.id, 0.0)
+            for rec in self
+        }
 
     @api.depends('product_id', 'months_history')
     def _compute_sales_data(self):
         """
         Calcula las ventas y la media mensual.
         """
-        if not self.product_id:
-            self.total_sold = 0
-            self.monthly_average = 0
-            return
+        values = self._get_sales_values()
+        for rec in self:
+            rec.update(values[rec.id])
+
+    def _get_sales_values(self):
+        sold_map = self._get_sales_totals()
+        values = {}
         for rec in self:
             if rec.months_history <= 0:
-                rec.total_sold = 0
-                rec.monthly_average = 0
+                values[rec.id] = {'total_sold': 0, 'monthly_average': 0}
                 continue
-            end_date = datetime.now()
-            start_date = end_date - timedelta(days=rec.months_history * 30.44)
+            total_sold = sold_map.get(rec.id, 0.0)
+            values[rec.id] = {'total_sold': total_sold, 'monthly_average': total_sold / rec.months_history}
+        return values
 
-            _logger.debug("start_date %s end_date %s",start_date, end_date)
-            sale_lines = self.env['sale.order.line'].search([
-                ('order_id.date_order', '>=', start_date),
-                ('order_id.date_order', '<=', end_date),
-                ('order_id.state', 'in', ['sale', 'done']),
-                ('product_id', '=', rec.product_id.id)
-            ])
-            total_sold = sum(line.product_uom_qty for line in sale_lines)
-            rec.total_sold = total_sold
-            rec.monthly_average = total_sold / rec.months_history if rec.months_history > 0 else 0
+    def _get_sales_totals(self):
+        """
+        Devuelve {id de previsión: unidades vendidas} para todo el recordset.
+        Agrupa las líneas por 'months_history' y, por cada ventana distinta,
+        suma los meses completos del histórico mensual (stock.forecast.sales.month)
+        en lugar de recorrer todas las líneas de venta de la ventana.
+        """
+        product_ids_by_window = defaultdict(list)
+        for rec in self:
+            if rec.product_id and rec.months_history > 0:
+                product_ids_by_window[rec.months_history].append(rec.product_id.id)
+
+        end_date = datetime.now()
+        sold_by_window = {}
+        for months_history, product_ids in product_ids_by_window.items():
+            start_date = end_date - timedelta(days=months_history * 30.44)
+            _logger.debug("start_date %s end_date %s", start_date, end_date)
+            sold_by_window[months_history] = self.env['stock.forecast.sales.month']._get_window_totals(
+                product_ids, start_date, end_date
+            )
+
+        return {
+            rec.id: sold_by_window.get(rec.months_history, {}).get(rec.product_id.id, 0.0)
+            for rec in self
+        }
+
+    @api.depends('product_id', 'months_history', 'forecast_model', 'monthly_average')
+    def _compute_forecast_demand(self):
+        """
+        Calcula la demanda mensual prevista con el modelo de cada línea.
+        """
+        demand_map = self._get_forecast_demand()
+        for rec in self:
+            rec.forecast_demand = demand_map.get(rec.id, 0.0)
+
+    def _get_forecast_demand(self):
+        """
+        Devuelve {id de previsión: demanda prevista}. La 'Media Simple' es la
+        Media Mes; el resto de modelos se calculan con forecast_engine sobre
+        una única matriz de demanda para todo el recordset, agrupando las
+        líneas por (modelo, meses de historial).
+        """
+        result = {}
+        records_by_model = defaultdict(list)
+        for rec in self:
+            if rec.forecast_model == 'average' or not rec.product_id or rec.months_history <= 0:
+                result[rec.id] = rec.monthly_average
+            else:
+                records_by_model[(rec.forecast_model, rec.months_history)].append(rec)
+
+        if not records_by_model:
+            return result
+
+        product_ids = list({rec.product_id.id for records in records_by_model.values() for rec in records})
+        n_months = max(forecast_engine.HISTORY_MONTHS, max(months for _model, months in records_by_model))
+        matrix = self._load_demand_matrix(product_ids, n_months)
+        row_by_product = {product_id: row for row, product_id in enumerate(product_ids)}
+
+        for (forecast_model, months_history), records in records_by_model.items():
+            rows = [row_by_product[rec.product_id.id] for rec in records]
+            demand = forecast_engine.forecast(forecast_model, matrix[rows], months_history)
+            for rec, value in zip(records, demand):
+                result[rec.id] = float(value)
+        return result
+
+    @api.model
+    def _load_demand_matrix(self, product_ids, n_months):
+        """
+        Carga en un array (productos x meses) las ventas de los últimos
+        'n_months' meses completos, en el orden de 'product_ids', con una
+        sola consulta al histórico mensual.
+        """
+        current_month = fields.Date.today().replace(day=1)
+        first_month = current_month - relativedelta(months=n_months)
+        groups = self.env['stock.forecast.sales.month']._read_group([
+            ('product_id', 'in', product_ids),
+            ('month', '>=', first_month),
+            ('month', '<', current_month),
+        ], ['product_id', 'month:month'], ['quantity:sum'])
+
+        matrix = np.zeros((len(product_ids), n_months))
+        if groups:
+            row_by_product = {product_id: row for row, product_id in enumerate(product_ids)}
+            rows = [row_by_product[product.id] for product, _month, _qty in groups]
+            cols = [
+                (month.year - first_month.year) * 12 + month.month - first_month.month
+                for _product, month, _qty in groups
+            ]
+            np.add.at(matrix, (rows, cols), [qty for _product, _month, qty in groups])
+        return matrix
 
     
     # funcion del boton de la derecha de Stock Entrante
@@ -252,13 +695,368 @@ class StockForecast(models.Model):
         """
         Acción para forzar el recálculo del stock manualmente.
         """
-        self.sudo()._compute_current_stock()
-        self.sudo()._compute_incoming_stock()
-        self.sudo()._compute_sales_data()
+        self._refresh_stock_data('manual', recompute_dated=True)
+
+    def _refresh_stock_data(self, trigger, components=REFRESH_COMPONENTS, recompute_dated=False):
+        """
+        Recalcula los componentes pedidos ('current', 'incoming', 'sales') y
+        escribe solo los valores que han cambiado, de modo que la demanda, la
+        proyección y la cobertura solo se recalculan, al volcar, en las líneas
+        cuyos datos de entrada han cambiado (la proyección, en todas las líneas
+        si se recalcula el entrante). Con 'recompute_dated' se recalculan
+        además en todas las líneas los campos que dependen de la fecha
+        (DATED_FIELDS). Deja un registro en
+        stock.forecast.refresh.log con el tiempo de cada fase y el número de
+        consultas SQL.
+        """
+        records = self.sudo()
+        cr = self.env.cr
+        queries_before = cr.sql_log_count
+        started = time.perf_counter()
+        durations = {}
+        for component in REFRESH_COMPONENTS:
+            if component not in components:
+                continue
+            stage_start = time.perf_counter()
+            if component == 'current':
+                stock_rows = records._get_stock_by_warehouse()
+                values = records._get_current_values(stock_rows)
+                records._update_warehouse_stock(stock_rows)
+            else:
+                values = getattr(records, f'_get_{component}_values')()
+            records._write_changed_values(values)
+            if component == 'incoming':
+                # Una entrada que solo cambia de fecha no cambia el total
+                for fname in PROJECTION_FIELDS:
+                    self.env.add_to_compute(records._fields[fname], records)
+            durations[component] = time.perf_counter() - stage_start
+
+        # La cobertura (y demanda/proyección) se recalcula al volcar
+        stage_start = time.perf_counter()
+        if recompute_dated:
+            for fname in DATED_FIELDS:
+                self.env.add_to_compute(records._fields[fname], records)
+        records.flush_recordset()
+        durations['coverage'] = time.perf_counter() - stage_start
+
+        self._log_refresh(trigger, len(records), durations, started, queries_before)
+
+    def _write_changed_values(self, values):
+        """
+        Escribe {id: {campo: valor}} solo en los campos cuyo valor (redondeado
+        como se guarda) es distinto del actual, con un único write por cada
+        combinación de valores cambiados.
+        """
+        ids_by_changes = defaultdict(list)
+        for rec in self:
+            changed = {
+                fname: value
+                for fname, value in values[rec.id].items()
+                if rec[fname] != self._fields[fname].convert_to_cache(value, rec)
+            }
+            if changed:
+                ids_by_changes[frozendict(changed)].append(rec.id)
+        for changed, ids in ids_by_changes.items():
+            self.browse(ids).write(dict(changed))
+
+    @api.model
+    def _log_refresh(self, trigger, record_count, durations, started, queries_before):
+        self.env['stock.forecast.refresh.log'].sudo().create({
+            'trigger': trigger,
+            'record_count': record_count,
+            'duration_current': durations.get('current', 0.0),
+            'duration_incoming': durations.get('incoming', 0.0),
+            'duration_sales': durations.get('sales', 0.0),
+            'duration_coverage': durations.get('coverage', 0.0),
+            'duration_total': time.perf_counter() - started,
+            'query_count': self.env.cr.sql_log_count - queries_before,
+        })
+
+    @api.model
+    def _apply_sales_delta(self, orders, sign, trigger):
+        """
+        Suma (sign=1) o resta (sign=-1) las cantidades de 'orders' en
+        total_sold y monthly_average de las líneas de previsión cuya ventana
+        de historial incluye la fecha del pedido, con un único UPDATE y sin
+        volver a recorrer el historial. La deriva que deja la ventana al
+        avanzar la corrige el recálculo completo nocturno (_cron_full_refresh).
+        En modo 'queue' solo encola el componente de ventas de los productos,
+        como el resto de hooks, y el cron lo recalcula por lotes.
+        """
+        if not orders:
+            return
+        refresh_mode = self.env['ir.config_parameter'].sudo().get_param(
+            'muemue_stock_forecast.refresh_mode', 'queue')
+        if refresh_mode != 'sync':
+            self._schedule_refresh(orders.order_line.product_id.ids, trigger, ('sales',))
+            return
+        cr = self.env.cr
+        queries_before = cr.sql_log_count
+        started = time.perf_counter()
+
+        self.env['stock.forecast.sales.month']._flush_sale_data()
+        self.flush_model(['product_id', 'months_history', 'total_sold', 'monthly_average'])
+        cr.execute(SQL("""
+            UPDATE stock_forecast f
+               SET total_sold = COALESCE(f.total_sold, 0) + delta.qty,
+                   monthly_average = (COALESCE(f.total_sold, 0) + delta.qty) / f.months_history
+              FROM (SELECT forecast.id AS forecast_id, %s * SUM(sol.product_uom_qty) AS qty
+                      FROM sale_order_line sol
+                      JOIN sale_order so ON so.id = sol.order_id
+                      JOIN stock_forecast forecast ON forecast.product_id = sol.product_id
+                     WHERE so.id IN %s
+                       AND forecast.months_history > 0
+                       AND so.date_order >= %s - forecast.months_history * interval '30.44 days'
+                  GROUP BY forecast.id) delta
+             WHERE f.id = delta.forecast_id
+         RETURNING f.id
+        """, sign, tuple(orders.ids), fields.Datetime.now()))
+        forecasts = self.sudo().browse([row[0] for row in cr.fetchall()])
+        if not forecasts:
+            return
+        # El UPDATE no pasa por el ORM: refresca la caché y recalcula lo que depende de las ventas
+        forecasts.invalidate_recordset(['total_sold', 'monthly_average'])
+        forecasts.modified(['total_sold', 'monthly_average'])
+        self._log_refresh(
+            trigger, len(forecasts), {'sales': time.perf_counter() - started}, started, queries_before
+        )
+
+    @api.model
+    def _schedule_refresh(self, product_ids, trigger, components=REFRESH_COMPONENTS):
+        """
+        Punto de entrada de los hooks de pedidos y albaranes, que indican qué
+        componentes cambian. En modo 'queue' (por defecto) solo encola los
+        productos y el cron los recalcula por lotes; en modo 'sync' recalcula
+        en el momento.
+        """
+        if not product_ids:
+            return
+        refresh_mode = self.env['ir.config_parameter'].sudo().get_param(
+            'muemue_stock_forecast.refresh_mode', 'queue')
+        if refresh_mode == 'sync':
+            forecasts = self.search([('product_id', 'in', product_ids)])
+            if forecasts:
+                forecasts._refresh_stock_data(trigger, components)
+            return
+        self.env['stock.forecast.refresh.queue'].sudo()._enqueue(product_ids, components)
+
+    @api.model
+    def _register_done_moves(self, current_product_ids, incoming_product_ids):
+        """
+        Acumula los productos de los movimientos hechos durante la transacción
+        y recalcula sus previsiones una sola vez al final: en modo 'queue' se
+        encolan justo antes del commit; en modo 'sync' se recalculan después
+        del commit, con un cursor nuevo, para no alargar la transacción que
+        ha movido el stock.
+        """
+        cr = self.env.cr
+        data = cr.precommit.data.get(DONE_MOVES_KEY)
+        if data is None:
+            data = cr.precommit.data[DONE_MOVES_KEY] = {'current': set(), 'incoming': set()}
+            cr.precommit.add(self._flush_done_moves)
+        data['current'].update(current_product_ids)
+        data['incoming'].update(incoming_product_ids)
+
+    @api.model
+    def _flush_done_moves(self):
+        data = self.env.cr.precommit.data.pop(DONE_MOVES_KEY, None)
+        if not data:
+            return
+        refreshes = [
+            (list(data['current'] - data['incoming']), ('current',)),
+            (list(data['incoming']), ('current', 'incoming')),
+        ]
+        refresh_mode = self.env['ir.config_parameter'].sudo().get_param(
+            'muemue_stock_forecast.refresh_mode', 'queue')
+        if refresh_mode != 'sync':
+            for product_ids, components in refreshes:
+                self._schedule_refresh(product_ids, 'move_done', components)
+            return
+
+        dbname = self.env.cr.dbname
+        uid = self.env.uid
+
+        @self.env.cr.postcommit.add
+        def _refresh_after_commit():
+            db_registry = Registry(dbname)
+            with db_registry.cursor() as cr:
+                env = api.Environment(cr, uid, {})
+                for product_ids, components in refreshes:
+                    env['stock.forecast']._schedule_refresh(product_ids, 'move_done', components)
+
+    @api.model
+    def _cron_full_refresh(self):
+        """
+        Recalcula toda la previsión por bloques de 'full_refresh_chunk_size'
+        líneas, confirmando la transacción tras cada bloque. El último id
+        procesado se guarda como punto de control: si el worker muere, la
+        siguiente ejecución continúa desde ahí. Si se agota el tiempo
+        ('full_refresh_time_limit' segundos) se vuelve a lanzar el cron.
+        """
+        ICP = self.env['ir.config_parameter'].sudo()
+        chunk_size = int(ICP.get_param('muemue_stock_forecast.full_refresh_chunk_size', 1000))
+        time_limit = int(ICP.get_param('muemue_stock_forecast.full_refresh_time_limit', 60))
+        last_id = int(ICP.get_param('muemue_stock_forecast.full_refresh_last_id', 0))
+        started = time.monotonic()
+
+        while True:
+            forecasts = self.sudo().search([('id', '>', last_id)], order='id', limit=chunk_size)
+            if not forecasts:
+                ICP.set_param('muemue_stock_forecast.full_refresh_last_id', 0)
+                _logger.info("Recálculo completo de la previsión terminado")
+                break
+
+            self.env.add_to_compute(self._fields['main_supplier_id'], forecasts)
+            forecasts._refresh_stock_data('cron', recompute_dated=True)
+            last_id = forecasts[-1].id
+            ICP.set_param('muemue_stock_forecast.full_refresh_last_id', last_id)
+            self.env.flush_all()
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()
+            # Libera la caché para que la memoria no crezca con el catálogo
+            self.env.invalidate_all()
+
+            if time.monotonic() - started > time_limit:
+                _logger.info("Recálculo completo de la previsión: pausa en id %s", last_id)
+                self.env.ref('muemue_stock_forecast.ir_cron_stock_forecast_full_refresh')._trigger()
+                break
 
         
 
     
+    def _get_order_proposals(self):
+        """
+        Devuelve [(línea, proveedor por defecto, cantidad a pedir)] para todo
+        el recordset. La usan el asistente "Pedir" y el generador de
+        propuestas en segundo plano.
+        """
+        price_resolver = SupplierPriceResolver(self.env, self.product_id)
+        proposals = []
+        for rec in self:
+            # Calcular la cantidad a pedir:
+            # (Stock Objetivo) - (Esto es la demanda prevista * los meses que se quieren cubrir)
+            target_stock = rec.forecast_demand * rec.forecast_months
+            current_and_incoming = rec.total_available_stock
+            # Si el cálculo es negativo (tenemos de más), no pedimos
+            quantity_to_order = max(math.ceil(target_stock - current_and_incoming), 0)
+
+            # Buscar el proveedor que Odoo elegiría para esta cantidad; si ningún
+            # tramo aplica, el primero de la lista
+            default_supplier = (
+                price_resolver.select_seller(rec.product_id, quantity_to_order)
+                or price_resolver.select_seller(rec.product_id)
+            ).partner_id
+            proposals.append((rec, default_supplier, quantity_to_order))
+        return proposals
+
+    def action_generate_reorder_proposals(self):
+        """
+        Lanza en segundo plano el generador de pedidos de compra para todas
+        las líneas que necesitan pedir; al terminar avisa al usuario.
+        """
+        self.env['stock.forecast.reorder.request'].sudo().create({
+            'user_id': self.env.uid,
+            'company_id': self.env.company.id,
+        })
+        self.env.ref('muemue_stock_forecast.ir_cron_stock_forecast_reorder_proposals').sudo()._trigger()
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'title': _('Propuestas de Compra'),
+                'message': _('Se están generando los pedidos de compra en segundo plano.'),
+                'type': 'info',
+            },
+        }
+
+    @api.model
+    def _cron_generate_reorder_proposals(self):
+        """
+        Atiende las peticiones pendientes del botón "Generar Pedidos", una vez
+        por compañía y avisando a cada usuario que la pidió. Sin peticiones
+        (la ejecución semanal) genera los pedidos de la compañía del cron.
+        Devuelve los ids de las solicitudes de presupuesto afectadas.
+        """
+        reorder_requests = self.env['stock.forecast.reorder.request'].sudo().search([])
+        if not reorder_requests:
+            return self._generate_reorder_proposals()
+        purchase_order_ids = set()
+        for company in reorder_requests.company_id:
+            company_requests = reorder_requests.filtered(lambda r: r.company_id == company)
+            purchase_order_ids.update(self.with_company(company)._generate_reorder_proposals(
+                company_requests.user_id))
+            company_requests.unlink()
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()
+        return sorted(purchase_order_ids)
+
+    @api.model
+    def _generate_reorder_proposals(self, users=None):
+        """
+        Recorre por lotes de 'reorder_batch_size' las líneas que necesitan
+        pedir, calcula la cantidad con la misma fórmula que el asistente y
+        añade las líneas a la solicitud de presupuesto en borrador de su
+        proveedor por defecto (o crea una). Los productos que ya están en una
+        solicitud en borrador se saltan, así que relanzar el job no duplica
+        líneas. Confirma la transacción tras cada lote y al terminar avisa a
+        'users' con el resumen.
+        """
+        ICP = self.env['ir.config_parameter'].sudo()
+        batch_size = int(ICP.get_param('muemue_stock_forecast.reorder_batch_size', 500))
+        order_wizard = self.env['stock.order.wizard']
+        purchase_line_model = self.env['purchase.order.line']
+        purchase_order_ids = set()
+        line_count = 0
+        skipped_count = 0
+        last_id = 0
+
+        while True:
+            forecasts = self.sudo().search(
+                [('need_reorder', '=', True), ('id', '>', last_id)], order='id', limit=batch_size)
+            if not forecasts:
+                break
+            last_id = forecasts[-1].id
+
+            already_ordered = {product for [product] in purchase_line_model._read_group([
+                ('product_id', 'in', forecasts.product_id.ids),
+                ('order_id.state', 'in', ['draft', 'sent']),
+                ('order_id.company_id', '=', self.env.company.id),
+            ], ['product_id'])}
+
+            quantities_by_supplier = defaultdict(list)
+            for rec, default_supplier, quantity_to_order in forecasts._get_order_proposals():
+                if not default_supplier or quantity_to_order <= 0 or rec.product_id in already_ordered:
+                    skipped_count += 1
+                    continue
+                quantities_by_supplier[default_supplier].append((rec.product_id, quantity_to_order))
+                line_count += 1
+
+            purchase_orders = order_wizard._create_purchase_orders(quantities_by_supplier, append_to_draft=True)
+            purchase_order_ids.update(purchase_orders.ids)
+            self.env.flush_all()
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()
+            self.env.invalidate_all()
+
+        message = _(
+            "%(lines)s líneas añadidas en %(orders)s solicitudes de presupuesto; %(skipped)s productos sin proveedor, sin cantidad o ya en borrador.",
+            lines=line_count, orders=len(purchase_order_ids), skipped=skipped_count,
+        )
+        _logger.info("Propuestas de compra: %s", message)
+        if users:
+            self._notify_reorder_proposals(users, message)
+        return sorted(purchase_order_ids)
+
+    @api.model
+    def _notify_reorder_proposals(self, users, message):
+        """Avisa con el resumen a los usuarios que lanzaron el generador."""
+        for user in users.sudo().exists():
+            self.env['bus.bus']._sendone(user.partner_id, 'simple_notification', {
+                'title': _('Propuestas de Compra'),
+                'message': message,
+                'sticky': True,
+            })
+
     def action_launch_order_wizard(self):
         """
         Esta es la función que llama la Acción de Servidor "Pedir".
@@ -269,25 +1067,8 @@ class StockForecast(models.Model):
         if not self:
             return
 
-        wizard_line_model = self.env['stock.order.wizard.line']
         wizard_lines = []
-
-        for rec in self:
-       
-
-            # Calcular la cantidad a pedir:
-            # (Stock Objetivo) - (Esto es la media de ventas * los meses que se quieren cubrir)
-            target_stock = rec.monthly_average * rec.forecast_months
-            current_and_incoming = rec.total_available_stock
-            quantity_to_order = math.ceil(target_stock - current_and_incoming)
-
-            # Si el cálculo es negativo (tenemos de más), no pedimos
-            if quantity_to_order <= 0:
-                quantity_to_order=0
-                
-            # Buscar el primer proveedor (defecto) de la lista
-            default_supplier = rec.product_id.seller_ids[:1].partner_id
-
+        for rec, default_supplier, quantity_to_order in self._get_order_proposals():
             if default_supplier:
                 line_vals = {
                     'forecast_id': rec.id,
@@ -0,0 +1,52 @@
+from odoo import models, fields, api
+from datetime import timedelta
+import logging
+_logger = logging.getLogger(__name__)
+
+class StockForecastRefreshLog(models.Model):
+    _name = 'stock.forecast.refresh.log'
+    _description = 'Registro de Recálculos de Previsión'
+    _order = 'create_date desc, id desc'
+
+    trigger = fields.Selection(
+        [
+            ('manual', 'Manual'),
+            ('cron', 'Cron Nocturno'),
+            ('queue', 'Cola de Recálculo'),
+            ('sale_confirm', 'Confirmación Venta'),
+            ('sale_cancel', 'Cancelación Venta'),
+            ('sale_update', 'Modificación Venta'),
+            ('po_confirm', 'Confirmación Compra'),
+            ('move_done', 'Movimiento Realizado'),
+            ('move_reschedule', 'Cambio Fecha Entrada'),
+        ],
+        string="Origen",
+        required=True,
+        readonly=True
+    )
+    record_count = fields.Integer(string="Líneas", readonly=True)
+    duration_current = fields.Float(string="Stock Mano (s)", digits=(12, 3), readonly=True, group_operator='avg')
+    duration_incoming = fields.Float(string="Stock Entrante (s)", digits=(12, 3), readonly=True, group_operator='avg')
+    duration_sales = fields.Float(string="Ventas (s)", digits=(12, 3), readonly=True, group_operator='avg')
+    duration_coverage = fields.Float(
+        string="Cobertura (s)",
+        digits=(12, 3),
+        readonly=True,
+        group_operator='avg',
+        help="Recálculo de demanda, proyección y cobertura, y escritura en base de datos."
+    )
+    duration_total = fields.Float(string="Total (s)", digits=(12, 3), readonly=True, group_operator='avg')
+    query_count = fields.Integer(string="Consultas SQL", readonly=True, group_operator='avg')
+
+
+    @api.autovacuum
+    def _gc_refresh_log(self):
+        """
+        Borra los registros más antiguos que 'refresh_log_retention_days'.
+        """
+        retention_days = int(self.env['ir.config_parameter'].sudo().get_param(
+            'muemue_stock_forecast.refresh_log_retention_days', 30))
+        limit_date = fields.Datetime.now() - timedelta(days=retention_days)
+        old_logs = self.sudo().search([('create_date', '<', limit_date)])
+        _logger.info("Registro de recálculos: borrando %s entradas antiguas", len(old_logs))
+        old_logs.unlink()
@@ -0,0 +1,93 @@
+from odoo import models, fields, api
+from odoo.tools import SQL
+from collections import defaultdict
+from .stock_forecast import REFRESH_COMPONENTS
+import logging
+_logger = logging.getLogger(__name__)
+
+class StockForecastRefreshQueue(models.Model):
+    _name = 'stock.forecast.refresh.queue'
+    _description = 'Cola de Recálculo de Previsión'
+    _order = 'id'
+    _log_access = False
+
+    product_id = fields.Many2one(
+        'product.product',
+        string="Producto",
+        required=True,
+        ondelete='cascade'
+    )
+    refresh_current = fields.Boolean(string="Recalcular Stock Actual")
+    refresh_incoming = fields.Boolean(string="Recalcular Stock Entrante")
+    refresh_sales = fields.Boolean(string="Recalcular Ventas")
+
+    _sql_constraints = [
+        ('product_id_uniq', 'unique(product_id)', 'El producto ya está en la cola de recálculo.')
+    ]
+
+
+    @api.model
+    def _enqueue(self, product_ids, components=REFRESH_COMPONENTS):
+        """
+        Añade a la cola los productos que tienen línea de previsión, marcando
+        los componentes a recalcular. Un producto ya encolado no se duplica:
+        se le suman los componentes nuevos.
+        """
+        if not product_ids:
+            return
+        self.env['stock.forecast'].flush_model(['product_id'])
+        flags = [component in components for component in REFRESH_COMPONENTS]
+        self.env.cr.execute(SQL("""
+            INSERT INTO stock_forecast_refresh_queue
+                        (product_id, refresh_current, refresh_incoming, refresh_sales)
+                 SELECT product_id, %s, %s, %s FROM stock_forecast WHERE product_id = ANY(%s)
+            ON CONFLICT (product_id) DO UPDATE
+                    SET refresh_current = stock_forecast_refresh_queue.refresh_current OR EXCLUDED.refresh_current,
+                        refresh_incoming = stock_forecast_refresh_queue.refresh_incoming OR EXCLUDED.refresh_incoming,
+                        refresh_sales = stock_forecast_refresh_queue.refresh_sales OR EXCLUDED.refresh_sales
+        """, *flags, list(product_ids)))
+        if self.env.cr.rowcount:
+            cron = self.env.ref('muemue_stock_forecast.ir_cron_stock_forecast_refresh_queue', raise_if_not_found=False)
+            if cron:
+                cron.sudo()._trigger()
+
+    @api.model
+    def _pop_batch(self, limit):
+        """
+        Saca de la cola hasta 'limit' productos y devuelve
+        {componentes a recalcular: [ids de producto]}.
+        SKIP LOCKED permite que dos workers vacíen la cola a la vez sin pisarse.
+        """
+        self.env.cr.execute(SQL("""
+            DELETE FROM stock_forecast_refresh_queue
+             WHERE id IN (SELECT id FROM stock_forecast_refresh_queue
+                           ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED)
+         RETURNING product_id, refresh_current, refresh_incoming, refresh_sales
+        """, limit))
+        product_ids_by_components = defaultdict(list)
+        for product_id, *flags in self.env.cr.fetchall():
+            components = tuple(c for c, flag in zip(REFRESH_COMPONENTS, flags) if flag)
+            product_ids_by_components[components].append(product_id)
+        return product_ids_by_components
+
+    @api.model
+    def _cron_process_queue(self):
+        """
+        Vacía la cola por lotes, recalculando las previsiones de cada lote y
+        confirmando la transacción entre lotes.
+        """
+        batch_size = int(self.env['ir.config_parameter'].sudo().get_param(
+            'muemue_stock_forecast.refresh_batch_size', 500))
+        forecast_model = self.env['stock.forecast'].sudo()
+        while True:
+            product_ids_by_components = self._pop_batch(batch_size)
+            if not product_ids_by_components:
+                break
+            for components, product_ids in product_ids_by_components.items():
+                forecasts = forecast_model.search([('product_id', 'in', product_ids)])
+                if forecasts:
+                    forecasts._refresh_stock_data('queue', components)
+                _logger.debug("Cola de previsión: %s productos recalculados (%s)",
+                              len(product_ids), ', '.join(components))
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()
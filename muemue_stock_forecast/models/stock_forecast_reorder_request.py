@@ -0,0 +1,20 @@
+from odoo import models, fields
+
+
+class StockForecastReorderRequest(models.Model):
+    _name = 'stock.forecast.reorder.request'
+    _description = 'Petición de Propuestas de Compra'
+    _order = 'id'
+
+    user_id = fields.Many2one(
+        'res.users',
+        string="Solicitado por",
+        required=True,
+        ondelete='cascade'
+    )
+    company_id = fields.Many2one(
+        'res.company',
+        string="Compañía",
+        required=True,
+        ondelete='cascade'
+    )
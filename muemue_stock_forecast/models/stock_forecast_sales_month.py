@@ -0,0 +1,141 @@
+from odoo import models, fields, api
+from odoo.tools import SQL, create_index
+from dateutil.relativedelta import relativedelta
+import logging
+_logger = logging.getLogger(__name__)
+
+class StockForecastSalesMonth(models.Model):
+    _name = 'stock.forecast.sales.month'
+    _description = 'Histórico Mensual de Ventas'
+    _order = 'month desc'
+    _log_access = False
+
+    product_id = fields.Many2one(
+        'product.product',
+        string="Producto",
+        required=True,
+        ondelete='cascade',
+        index=True
+    )
+    company_id = fields.Many2one(
+        'res.company',
+        string="Compañía",
+        required=True,
+        ondelete='cascade'
+    )
+    month = fields.Date(
+        string="Mes",
+        required=True,
+        help="Primer día del mes (UTC) de la fecha de pedido."
+    )
+    quantity = fields.Float(
+        string="Unidades Vendidas",
+        help="Suma de product_uom_qty de las líneas de pedidos confirmados del mes."
+    )
+
+    _sql_constraints = [
+        ('product_company_month_uniq', 'unique(product_id, company_id, month)',
+         'Ya existe un histórico para este producto, compañía y mes.')
+    ]
+
+    def init(self):
+        # Las lecturas por ventana filtran por producto y rango de meses
+        create_index(self.env.cr, 'stock_forecast_sales_month_product_month_idx',
+                     self._table, ['product_id', 'month'])
+
+    def _flush_sale_data(self):
+        """
+        Las consultas de esta tabla leen sale_order(_line) directamente en SQL,
+        así que hay que volcar antes los cambios pendientes del ORM.
+        """
+        self.env['sale.order'].flush_model(['date_order', 'company_id', 'state'])
+        self.env['sale.order.line'].flush_model(['order_id', 'product_id', 'product_uom_qty'])
+
+    @api.model
+    def _add_orders(self, orders, sign=1):
+        """
+        Suma (sign=1) o resta (sign=-1) las líneas de 'orders' en su mes.
+        Se llama al confirmar y al cancelar pedidos de venta.
+        """
+        if not orders:
+            return
+        self._add_sales(SQL("so.id IN %s", tuple(orders.ids)), sign)
+
+    @api.model
+    def _add_order_lines(self, lines, sign=1):
+        """
+        Suma (sign=1) o resta (sign=-1) 'lines' en su mes. Se llama al crear,
+        modificar o borrar líneas de pedidos ya confirmados: se resta lo que
+        había antes del cambio y se suma lo que queda después.
+        """
+        if not lines:
+            return
+        self._add_sales(SQL("sol.id IN %s", tuple(lines.ids)), sign)
+
+    def _add_sales(self, condition, sign):
+        self._flush_sale_data()
+        self.env.cr.execute(SQL("""
+            INSERT INTO stock_forecast_sales_month (product_id, company_id, month, quantity)
+                 SELECT sol.product_id, so.company_id,
+                        date_trunc('month', so.date_order)::date,
+                        %s * SUM(sol.product_uom_qty)
+                   FROM sale_order_line sol
+                   JOIN sale_order so ON so.id = sol.order_id
+                  WHERE %s AND sol.product_id IS NOT NULL
+               GROUP BY 1, 2, 3
+            ON CONFLICT (product_id, company_id, month)
+            DO UPDATE SET quantity = stock_forecast_sales_month.quantity + EXCLUDED.quantity
+        """, sign, condition))
+        self.invalidate_model()
+
+    @api.model
+    def _rebuild(self):
+        """
+        Reconstruye la tabla entera a partir de los pedidos confirmados.
+        Se usa para la carga inicial y para corregir desviaciones (por ejemplo,
+        cantidades modificadas en pedidos ya confirmados).
+        """
+        self._flush_sale_data()
+        self.env.cr.execute("DELETE FROM stock_forecast_sales_month")
+        self.env.cr.execute("""
+            INSERT INTO stock_forecast_sales_month (product_id, company_id, month, quantity)
+                 SELECT sol.product_id, so.company_id,
+                        date_trunc('month', so.date_order)::date,
+                        SUM(sol.product_uom_qty)
+                   FROM sale_order_line sol
+                   JOIN sale_order so ON so.id = sol.order_id
+                  WHERE so.state IN ('sale', 'done') AND sol.product_id IS NOT NULL
+               GROUP BY 1, 2, 3
+        """)
+        _logger.info("Histórico mensual de ventas reconstruido: %s filas", self.env.cr.rowcount)
+        self.invalidate_model()
+
+    @api.model
+    def _get_window_totals(self, product_ids, start_date, end_date):
+        """
+        Devuelve {product_id: unidades vendidas} entre start_date y end_date.
+        Los meses completos se leen de esta tabla; solo el mes inicial, que la
+        ventana corta a la mitad, se suma desde las líneas de venta.
+        """
+        if not product_ids:
+            return {}
+        start_month = start_date.date().replace(day=1)
+        next_month_dt = fields.Datetime.to_datetime(start_month + relativedelta(months=1))
+
+        month_groups = self._read_group([
+            ('product_id', 'in', product_ids),
+            ('month', '>', start_month),
+            ('month', '<=', end_date.date()),
+        ], ['product_id'], ['quantity:sum'])
+        totals = {product.id: qty for product, qty in month_groups}
+
+        partial_groups = self.env['sale.order.line']._read_group([
+            ('order_id.date_order', '>=', start_date),
+            ('order_id.date_order', '<', min(next_month_dt, end_date)),
+            ('order_id.state', 'in', ['sale', 'done']),
+            ('product_id', 'in', product_ids)
+        ], ['product_id'], ['product_uom_qty:sum'])
+        for product, qty in partial_groups:
+            totals[product.id] = totals.get(product.id, 0.0) + qty
+        return totals
+
@@ -0,0 +1,28 @@
+from odoo import models, fields, api
+
+class StockForecastWarehouse(models.Model):
+    _name = 'stock.forecast.warehouse'
+    _description = 'Stock por Almacén de la Previsión'
+    _order = 'forecast_id, warehouse_id'
+    _log_access = False
+
+    forecast_id = fields.Many2one(
+        'stock.forecast',
+        string="Línea de Previsión",
+        required=True,
+        ondelete='cascade',
+        index=True
+    )
+    warehouse_id = fields.Many2one(
+        'stock.warehouse',
+        string="Almacén",
+        required=True,
+        ondelete='cascade',
+        index=True
+    )
+    quantity = fields.Float(string="Stock Mano")
+
+    @api.depends('warehouse_id', 'quantity')
+    def _compute_display_name(self):
+        for rec in self:
+            rec.display_name = f"{rec.warehouse_id.code}: {rec.quantity:g}"
@@ -0,0 +1,102 @@
+from odoo import models, fields, _
+from odoo.tools import SQL
+from dateutil.relativedelta import relativedelta
+import logging
+_logger = logging.getLogger(__name__)
+
+class StockForecastWizard(models.TransientModel):
+    _name = 'stock.forecast.wizard'
+    _description = 'Asistente para Poblar la Previsión de Stock'
+
+    categ_ids = fields.Many2many(
+        'product.category',
+        string="Categorías",
+        help="Solo productos de estas categorías (incluidas sus subcategorías)."
+    )
+    supplier_ids = fields.Many2many(
+        'res.partner',
+        string="Proveedores",
+        help="Solo productos con alguno de estos proveedores."
+    )
+    sold_months = fields.Integer(
+        string="Vendidos en los Últimos Meses",
+        default=0,
+        help="Solo productos con ventas en los últimos N meses. 0 = no filtrar."
+    )
+    storable_only = fields.Boolean(
+        string="Solo Almacenables",
+        default=True
+    )
+    months_history = fields.Integer(string="Meses Hist.", default=3)
+    forecast_months = fields.Integer(string="Meses Previsión", default=3)
+
+
+    def _get_product_domain(self):
+        self.ensure_one()
+        domain = []
+        if self.categ_ids:
+            domain.append(('categ_id', 'child_of', self.categ_ids.ids))
+        if self.supplier_ids:
+            domain.append(('product_tmpl_id.seller_ids.partner_id', 'in', self.supplier_ids.ids))
+        if self.storable_only:
+            domain.append(('detailed_type', '=', 'product'))
+        return domain
+
+    def action_populate(self):
+        """
+        Añade a la previsión todas las variantes que cumplen los filtros con
+        un único INSERT ... SELECT. Las que ya están se ignoran por la
+        restricción product_id_uniq, y las nuevas se calculan en un solo lote.
+        """
+        self.ensure_one()
+        query = self.env['product.product']._search(self._get_product_domain())
+        if self.sold_months > 0:
+            first_month = fields.Date.today().replace(day=1) - relativedelta(months=self.sold_months - 1)
+            query.add_where(SQL(
+                "%s IN (SELECT product_id FROM stock_forecast_sales_month WHERE month >= %s AND quantity > 0)",
+                SQL.identifier(query.table, 'id'), first_month,
+            ))
+
+        forecast_model = self.env['stock.forecast']
+        forecast_model.flush_model()
+        now = fields.Datetime.now()
+        select_sql = query.select(SQL(
+            "%s, %s, %s, %s, %s, %s, %s, %s",
+            SQL.identifier(query.table, 'id'),
+            self.months_history, self.forecast_months, 'average',
+            self.env.uid, self.env.uid, now, now,
+        ))
+        self.env.cr.execute(SQL("""
+            INSERT INTO stock_forecast (product_id, months_history, forecast_months, forecast_model,
+                                        create_uid, write_uid, create_date, write_date)
+            %s
+            ON CONFLICT ON CONSTRAINT stock_forecast_product_id_uniq DO NOTHING
+            RETURNING id
+        """, select_sql))
+        forecasts = forecast_model.browse([row[0] for row in self.env.cr.fetchall()])
+        _logger.info("Poblar previsión: %s líneas nuevas", len(forecasts))
+
+        if forecasts:
+            # Un único recálculo por campo para todas las líneas nuevas
+            for field in forecast_model._fields.values():
+                if field.compute and field.store:
+                    self.env.add_to_compute(field, forecasts)
+            # El INSERT no pasa por el ORM: hay que avisar a las plantillas
+            forecasts.product_id.invalidate_recordset(['forecast_ids'])
+            self.env.add_to_compute(
+                self.env['product.template']._fields['in_forecast'],
+                forecasts.product_id.product_tmpl_id,
+            )
+            forecasts.flush_recordset()
+            forecasts.product_id.product_tmpl_id.flush_recordset(['in_forecast'])
+            forecasts._update_warehouse_stock(forecasts._get_stock_by_warehouse())
+
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'type': 'success',
+                'message': _("Se han añadido %s productos a la previsión.", len(forecasts)),
+                'next': {'type': 'ir.actions.client', 'tag': 'reload'},
+            },
+        }
@@ -0,0 +1,28 @@
+from odoo import models
+
+class StockMove(models.Model):
+    _inherit = 'stock.move'
+
+    def write(self, vals):
+        res = super().write(vals)
+        if 'date' in vals:
+            # Reprogramar una recepción (también al cambiar la fecha prevista
+            # del albarán) mueve la proyección aunque no cambie el entrante
+            rescheduled = self.filtered(
+                lambda m: m.picking_code == 'incoming' and m.state not in ('draft', 'done', 'cancel'))
+            self.env['stock.forecast']._schedule_refresh(
+                rescheduled.product_id.ids, 'move_reschedule', ('incoming',))
+        return res
+
+    def _action_done(self, cancel_backorder=False):
+        moves = super()._action_done(cancel_backorder=cancel_backorder)
+
+        # Entregas, movimientos internos, desechos y ajustes de inventario
+        # cambian el stock a mano; las recepciones, además, el entrante.
+        done_moves = moves.filtered(lambda m: m.state == 'done')
+        incoming_moves = done_moves.filtered(lambda m: m.picking_code == 'incoming')
+        self.env['stock.forecast']._register_done_moves(
+            (done_moves - incoming_moves).product_id.ids,
+            incoming_moves.product_id.ids,
+        )
+        return moves
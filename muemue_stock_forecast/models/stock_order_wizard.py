@@ -1,6 +1,7 @@
 from odoo import models, fields, api, _
 from odoo.exceptions import UserError
 from collections import defaultdict
+from .supplier_price_resolver import SupplierPriceResolver
 
 class StockOrderWizard(models.TransientModel):
     _name = 'stock.order.wizard'
@@ -12,6 +13,12 @@ class StockOrderWizard(models.TransientModel):
         string="Líneas de Producto"
     )
 
+    append_to_draft = fields.Boolean(
+        string="Añadir a Borradores",
+        help="Si se marca, las líneas se añaden a la última solicitud de presupuesto "
+             "en borrador del proveedor en lugar de crear un pedido nuevo."
+    )
+
     def action_generate_purchase_orders(self):
         """
         Esta es la lógica del botón "Aceptar".
@@ -21,57 +28,16 @@ class StockOrderWizard(models.TransientModel):
             raise UserError("No hay líneas para pedir.")
 
         # Agrupa líneas por proveedor
-        lines_by_supplier = defaultdict(lambda: self.env['stock.order.wizard.line'])
+        quantities_by_supplier = defaultdict(list)
         for line in self.line_ids:
             if not line.supplier_id:
                 raise UserError(f"Por favor, selecciona un proveedor para el producto '{line.product_id.name}'.")
-            if line.quantity_to_order == 0:
-                line.quantity_to_order=0
-              
-            lines_by_supplier[line.supplier_id] |= line
-
-        po_model = self.env['purchase.order']
-        po_line_model = self.env['purchase.order.line']
-        created_pos = []
+            quantities_by_supplier[line.supplier_id].append((line.product_id, line.quantity_to_order))
 
-        # Crear un Pedido de Compra (PO) por cada proveedor
-        for supplier, lines in lines_by_supplier.items():
-            po_vals = {
-                'partner_id': supplier.id,
-                'state': 'draft',
-                'date_order': fields.Datetime.now(),
-                #Aqui luego se podrian poner mas valores
-            }
-            new_po = po_model.create(po_vals)
-            created_pos.append(new_po.id)
-
-            # Crear las líneas del Pedido de Compra
-            for line in lines:
-                product = line.product_id
-                supplier = line.supplier_id
-                  
-                  #seller_ids devuelve una lista de product.supplierinfo, en este tipo de objeto estan las propiedades del supplier
-
-                  #aqui se escoge el product.supplierinfo del proveedor 
-                seller_info = product.seller_ids.filtered(
-                    lambda s: s.partner_id.id == supplier.id
-                )
-                unit_price= 0.0
-                if seller_info:
-                    unit_price=seller_info[0].price
-                po_line_vals = {
-                    'order_id': new_po.id,
-                    'product_id': line.product_id.id,
-                    'product_qty': line.quantity_to_order,
-                    'price_unit': unit_price,
-                    'date_planned': fields.Date.today(),
-                    'name': line.product_id.display_name,
-                    'product_uom': line.product_id.uom_po_id.id or line.product_id.uom_id.id,
-                }
-                po_line_model.create(po_line_vals)
+        purchase_orders = self._create_purchase_orders(quantities_by_supplier, self.append_to_draft)
         
         # Abrir la lista de Pedidos de Compra recién creados
-        if not created_pos:
+        if not purchase_orders:
             raise UserError("No se crearon pedidos (cantidades a 0).")
 
         return {
@@ -79,9 +45,89 @@ class StockOrderWizard(models.TransientModel):
             'type': 'ir.actions.act_window',
             'res_model': 'purchase.order',
             'view_mode': 'tree,form',
-            'domain': [('id', 'in', created_pos)],
+            'domain': [('id', 'in', purchase_orders.ids)],
+        }
+
+    @api.model
+    def _create_purchase_orders(self, quantities_by_supplier, append_to_draft=False):
+        """
+        Crea los pedidos de compra a partir de {proveedor: [(producto, cantidad), ...]}.
+        Los precios salen de SupplierPriceResolver (una sola búsqueda de
+        tarifas, con tramos por cantidad), y las líneas de cada proveedor se crean
+        con un único create(). Con 'append_to_draft' se reutiliza la última
+        solicitud en borrador de cada proveedor, y si ya tiene una línea del
+        producto en la misma unidad se le suma la cantidad en lugar de añadir
+        otra.
+        Devuelve los purchase.order usados.
+        """
+        if not quantities_by_supplier:
+            return self.env['purchase.order']
+
+        suppliers = self.env['res.partner'].union(*quantities_by_supplier)
+        products = self.env['product.product'].union(*(
+            product for items in quantities_by_supplier.values() for product, _qty in items
+        ))
+
+        # Mismo criterio de precio que muestra el asistente
+        price_resolver = SupplierPriceResolver(self.env, products)
+
+        po_model = self.env['purchase.order']
+        po_by_supplier = {}
+        if append_to_draft:
+            for purchase_order in po_model.search([
+                ('partner_id', 'in', suppliers.ids),
+                ('state', '=', 'draft'),
+                ('company_id', '=', self.env.company.id)
+            ], order='id desc'):
+                po_by_supplier.setdefault(purchase_order.partner_id, purchase_order)
+
+        # Crear un Pedido de Compra (PO) por cada proveedor que no tenga ya uno
+        new_suppliers = suppliers.filtered(lambda supplier: supplier not in po_by_supplier)
+        if new_suppliers:
+            new_pos = po_model.create([{
+                'partner_id': supplier.id,
+                'state': 'draft',
+                'date_order': fields.Datetime.now(),
+                #Aqui luego se podrian poner mas valores
+            } for supplier in new_suppliers])
+            po_by_supplier.update(zip(new_suppliers, new_pos))
+
+        # Líneas que ya tienen las solicitudes reutilizadas, por (pedido, producto, unidad)
+        existing_lines = {
+            (line.order_id, line.product_id, line.product_uom): line
+            for line in po_model.union(*po_by_supplier.values()).order_line
+            if line.product_id and not line.display_type
         }
 
+        # Crear las líneas del Pedido de Compra, un create() por proveedor
+        po_line_model = self.env['purchase.order.line']
+        today = fields.Date.today()
+        for supplier, items in quantities_by_supplier.items():
+            purchase_order = po_by_supplier[supplier]
+            po_line_vals = []
+            for product, quantity in items:
+                product_uom = product.uom_po_id or product.uom_id
+                existing_line = existing_lines.get((purchase_order, product, product_uom))
+                if existing_line:
+                    product_qty = existing_line.product_qty + quantity
+                    existing_line.write({
+                        'product_qty': product_qty,
+                        'price_unit': price_resolver.get_price(product, product_qty, supplier),
+                    })
+                    continue
+                po_line_vals.append({
+                    'order_id': purchase_order.id,
+                    'product_id': product.id,
+                    'product_qty': quantity,
+                    'price_unit': price_resolver.get_price(product, quantity, supplier),
+                    'date_planned': today,
+                    'name': product.display_name,
+                    'product_uom': product.uom_po_id.id or product.uom_id.id,
+                })
+            po_line_model.create(po_line_vals)
+
+        return po_model.union(*po_by_supplier.values())
+
 
 class StockOrderWizardLine(models.TransientModel):
     _name = 'stock.order.wizard.line'
@@ -125,26 +171,19 @@ class StockOrderWizardLine(models.TransientModel):
             line.supplier_partner_ids = line.product_id.seller_ids.partner_id
     
 
-    @api.depends('supplier_id', 'product_id')
+    @api.depends('supplier_id', 'product_id', 'quantity_to_order')
     def _compute_unit_price(self):
         """
-        Calcula el precio unitario basado en el producto y el proveedor seleccionado.
+        Calcula el precio unitario basado en el producto, el proveedor
+        seleccionado y el tramo de cantidad a pedir.
         """
+        price_resolver = SupplierPriceResolver(self.env, self.product_id)
         for line in self:
             if not line.product_id or not line.supplier_id:
                 line.unit_price = 0.0
                 continue
 
-            product = line.product_id # Esto es un 'product.product'
-            supplier = line.supplier_id # Esto es un 'res.partner'
-
-            seller_info = self.env['product.supplierinfo'].search([
-                ('product_tmpl_id', '=', product.product_tmpl_id.id),
-                ('partner_id', '=', supplier.id)
-            ], limit=1)
-            
-            if seller_info:
-                line.unit_price = seller_info.price
-            else:
-                # Si no encuentra nada, pone 0.0
-                line.unit_price = 0.0
+            # Si no encuentra nada, pone 0.0
+            line.unit_price = price_resolver.get_price(
+                line.product_id, line.quantity_to_order, line.supplier_id
+            )
@@ -0,0 +1,59 @@
+from collections import defaultdict
+
+from odoo import fields
+from odoo.tools import float_compare
+
+
+class SupplierPriceResolver:
+    """
+    Elige el product.supplierinfo que Odoo usaría en el pedido de compra
+    (mismas reglas que product.product._select_seller: proveedor activo,
+    compañía, fechas de validez, tramos de cantidad mínima y filas
+    específicas de variante), pero
+    cargando todas las tarifas de los productos con una sola búsqueda y
+    resolviendo después en memoria.
+    """
+
+    def __init__(self, env, products, date=None):
+        self.env = env
+        self.date = date or fields.Date.context_today(env.user)
+        self.precision = env['decimal.precision'].precision_get('Product Unit of Measure')
+        sellers = env['product.supplierinfo'].search([
+            ('product_tmpl_id', 'in', products.product_tmpl_id.ids),
+            ('company_id', 'in', [False, env.company.id]),
+            ('partner_id.active', '=', True),
+        ])
+        self._sellers_by_template = defaultdict(list)
+        for seller in sellers.sorted(lambda s: (s.sequence, -s.min_qty, s.price, s.id)):
+            self._sellers_by_template[seller.product_tmpl_id.id].append(seller)
+
+    def select_seller(self, product, quantity=None, partner=None):
+        """
+        Devuelve la tarifa aplicable a 'product' para 'quantity' (en la unidad
+        del producto) y, si se indica, del proveedor 'partner'. Con
+        quantity=None no se tienen en cuenta los tramos de cantidad.
+        """
+        candidates = self.env['product.supplierinfo']
+        for seller in self._sellers_by_template.get(product.product_tmpl_id.id, []):
+            if seller.date_start and seller.date_start > self.date:
+                continue
+            if seller.date_end and seller.date_end < self.date:
+                continue
+            if partner and seller.partner_id not in (partner, partner.parent_id):
+                continue
+            if quantity is not None:
+                quantity_uom_seller = quantity
+                if quantity and seller.product_uom and product.uom_id != seller.product_uom:
+                    quantity_uom_seller = product.uom_id._compute_quantity(quantity, seller.product_uom)
+                if float_compare(quantity_uom_seller, seller.min_qty, precision_digits=self.precision) == -1:
+                    continue
+            if seller.product_id and seller.product_id != product:
+                continue
+            # Como Odoo: solo tarifas del primer proveedor válido, y de ellas la más barata
+            if not candidates or candidates.partner_id == seller.partner_id:
+                candidates |= seller
+        return candidates and candidates.sorted('price')[:1]
+
+    def get_price(self, product, quantity, partner):
+        seller = self.select_seller(product, quantity, partner)
+        return seller.price if seller else 0.0
@@ -0,0 +1,4 @@
+from . import test_stock_forecast_query_count
+from . import test_stock_forecast_benchmark
+from . import test_stock_forecast_refresh
+from . import test_stock_forecast_reorder
@@ -0,0 +1,122 @@
+import logging
+import os
+import random
+import time
+from datetime import timedelta
+
+from odoo import fields
+from odoo.tests import common
+
+_logger = logging.getLogger(__name__)
+
+
+def env_int(name, default):
+    """Tamaño del dataset configurable por variable de entorno."""
+    return int(os.environ.get(name, default))
+
+
+class StockForecastDatasetCase(common.TransactionCase):
+    """
+    Base para los tests de la previsión: genera un dataset sintético
+    (variantes, líneas de venta, movimientos entrantes y ubicaciones con
+    quants) y mide tiempo y número de consultas SQL de una operación.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.env = cls.env(context=dict(cls.env.context, tracking_disable=True))
+        cls.random = random.Random(42)
+        cls.warehouse = cls.env['stock.warehouse'].search(
+            [('company_id', '=', cls.env.company.id)], limit=1
+        )
+        cls.customer = cls.env['res.partner'].create({'name': 'Bench Customer'})
+        cls.suppliers = cls.env['res.partner'].create([
+            {'name': f'Bench Supplier {i}'} for i in range(3)
+        ])
+
+    @classmethod
+    def _generate_dataset(cls, n_variants, n_sale_lines, n_incoming_moves, n_locations):
+        """
+        Crea n_variants productos almacenables con proveedor, n_sale_lines
+        líneas de venta confirmadas repartidas en los últimos 12 meses,
+        n_incoming_moves movimientos entrantes en los próximos 90 días y
+        stock repartido en n_locations ubicaciones internas.
+        Devuelve las líneas de previsión de todos los productos.
+        """
+        rand = cls.random
+        products = cls.env['product.product'].create([{
+            'name': f'Bench Product {i}',
+            'default_code': f'BENCH{i:06d}',
+            'detailed_type': 'product',
+            'seller_ids': [(0, 0, {
+                'partner_id': cls.suppliers[i % len(cls.suppliers)].id,
+                'price': 10.0 + i % 7,
+            })],
+        } for i in range(n_variants)])
+
+        now = fields.Datetime.now()
+        order_vals = []
+        for start in range(0, n_sale_lines, 20):
+            order_vals.append({
+                'partner_id': cls.customer.id,
+                'state': 'sale',
+                'date_order': now - timedelta(days=rand.randint(0, 365)),
+                'order_line': [(0, 0, {
+                    'product_id': rand.choice(products).id,
+                    'product_uom_qty': rand.randint(1, 10),
+                }) for _line in range(min(20, n_sale_lines - start))],
+            })
+        cls.env['sale.order'].create(order_vals)
+
+        picking_vals = []
+        for start in range(0, n_incoming_moves, 20):
+            picking_vals.append({
+                'picking_type_id': cls.warehouse.in_type_id.id,
+                'partner_id': cls.suppliers[0].id,
+                'location_id': cls.env.ref('stock.stock_location_suppliers').id,
+                'location_dest_id': cls.warehouse.lot_stock_id.id,
+                'scheduled_date': now + timedelta(days=rand.randint(1, 90)),
+                'move_ids': [(0, 0, {
+                    'name': 'Bench incoming',
+                    'product_id': product.id,
+                    'product_uom': product.uom_id.id,
+                    'product_uom_qty': rand.randint(1, 50),
+                    'location_id': cls.env.ref('stock.stock_location_suppliers').id,
+                    'location_dest_id': cls.warehouse.lot_stock_id.id,
+                }) for product in (rand.choice(products) for _move in range(min(20, n_incoming_moves - start)))],
+            })
+        cls.env['stock.picking'].create(picking_vals).action_confirm()
+
+        locations = cls.env['stock.location'].create([{
+            'name': f'Bench Bin {i}',
+            'usage': 'internal',
+            'location_id': cls.warehouse.lot_stock_id.id,
+        } for i in range(n_locations)])
+        cls.env['stock.quant'].sudo().create([{
+            'product_id': product.id,
+            'location_id': location.id,
+            'quantity': rand.randint(0, 20),
+        } for product in products for location in locations])
+
+        cls.env['stock.forecast.sales.month']._rebuild()
+        wizard = cls.env['stock.forecast.wizard'].create({'storable_only': True})
+        wizard.action_populate()
+        return cls.env['stock.forecast'].search([('product_id', 'in', products.ids)])
+
+    def _measure(self, label, func, *args, flush=True):
+        """
+        Ejecuta func(*args) y registra el tiempo y el número de consultas SQL.
+        Con flush=False no se cuentan las escrituras pendientes del ORM.
+        Devuelve (resultado, segundos, consultas).
+        """
+        self.env.flush_all()
+        queries_before = self.env.cr.sql_log_count
+        start = time.perf_counter()
+        result = func(*args)
+        if flush:
+            self.env.flush_all()
+        elapsed = time.perf_counter() - start
+        queries = self.env.cr.sql_log_count - queries_before
+        _logger.info("BENCH %-40s %9.3fs %7d consultas", label, elapsed, queries)
+        return result, elapsed, queries
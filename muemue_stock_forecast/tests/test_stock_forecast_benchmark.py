@@ -0,0 +1,65 @@
+from odoo.tests import Form, tagged
+
+from .common import StockForecastDatasetCase, env_int
+
+# Benchmark con datos sintéticos. No se ejecuta con los tests normales:
+#   odoo-bin -d <db> -i muemue_stock_forecast --test-tags muemue_benchmark
+# Tamaños: MUEMUE_BENCH_VARIANTS, MUEMUE_BENCH_SALE_LINES,
+#          MUEMUE_BENCH_INCOMING_MOVES, MUEMUE_BENCH_LOCATIONS
+
+
+@tagged('post_install', '-at_install', '-standard', 'muemue_benchmark')
+class TestStockForecastBenchmark(StockForecastDatasetCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.forecasts = cls._generate_dataset(
+            env_int('MUEMUE_BENCH_VARIANTS', 1000),
+            env_int('MUEMUE_BENCH_SALE_LINES', 20000),
+            env_int('MUEMUE_BENCH_INCOMING_MOVES', 2000),
+            env_int('MUEMUE_BENCH_LOCATIONS', 10),
+        )
+
+    def test_01_refresh_stock_data(self):
+        self._measure(
+            f"action_refresh_stock_data ({len(self.forecasts)})",
+            self.forecasts.action_refresh_stock_data,
+        )
+
+    def test_02_sale_order_confirm(self):
+        order_form = Form(self.env['sale.order'])
+        order_form.partner_id = self.customer
+        for forecast in self.forecasts[:200]:
+            with order_form.order_line.new() as line:
+                line.product_id = forecast.product_id
+                line.product_uom_qty = 1
+        order = order_form.save()
+        self._measure("sale.order action_confirm (200 líneas)", order.action_confirm)
+        self._measure("cola: _cron_process_queue", self.env['stock.forecast.refresh.queue']._cron_process_queue)
+
+    def test_03_purchase_order_confirm_and_receive(self):
+        purchase_order = self.env['purchase.order'].create({
+            'partner_id': self.suppliers[0].id,
+            'order_line': [(0, 0, {
+                'product_id': forecast.product_id.id,
+                'product_qty': 5,
+            }) for forecast in self.forecasts[:200]],
+        })
+        self._measure("purchase.order button_confirm (200 líneas)", purchase_order.button_confirm)
+        picking = purchase_order.picking_ids
+        picking.move_ids.quantity = 5
+        picking.move_ids.picked = True
+        self._measure("stock.picking button_validate (200 líneas)", picking.button_validate)
+        self._measure("cola: _cron_process_queue", self.env['stock.forecast.refresh.queue']._cron_process_queue)
+
+    def test_04_order_wizard(self):
+        action, _elapsed, _queries = self._measure(
+            f"action_launch_order_wizard ({len(self.forecasts)})",
+            self.forecasts.action_launch_order_wizard,
+        )
+        wizard = self.env['stock.order.wizard'].browse(action['res_id'])
+        self._measure(
+            f"action_generate_purchase_orders ({len(wizard.line_ids)})",
+            wizard.action_generate_purchase_orders,
+        )
@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta
+
+from odoo.tests import tagged
+
+from .common import StockForecastDatasetCase
+
+# El número de consultas de estas operaciones no debe crecer con el número
+# de líneas de previsión: si alguien vuelve a lanzar una consulta por
+# registro, el recuento con más líneas se dispara y el test falla.
+QUERY_MARGIN = 5
+
+
+@tagged('post_install', '-at_install')
+class TestStockForecastQueryCount(StockForecastDatasetCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.forecasts = cls._generate_dataset(60, 600, 120, 3)
+        cls.small = cls.forecasts[:10]
+
+    def assertConstantQueries(self, label, method_name):
+        _res, _elapsed, small_queries = self._measure(
+            f"{label} ({len(self.small)})", getattr(self.small, method_name), flush=False
+        )
+        self.env.invalidate_all()
+        _res, _elapsed, large_queries = self._measure(
+            f"{label} ({len(self.forecasts)})", getattr(self.forecasts, method_name), flush=False
+        )
+        self.assertLessEqual(
+            large_queries, small_queries + QUERY_MARGIN,
+            f"{label}: {small_queries} consultas con {len(self.small)} líneas "
+            f"y {large_queries} con {len(self.forecasts)}",
+        )
+
+    def test_refresh_stock_data_query_count(self):
+        """
+        El recálculo completo, incluido el volcado, solo añade el UPDATE de
+        cada línea cambiada a un número de consultas fijo.
+        """
+        _res, _elapsed, small_queries = self._measure(
+            f"_refresh_stock_data ({len(self.small)})", self.small._refresh_stock_data, 'manual'
+        )
+        self.env.invalidate_all()
+        _res, _elapsed, large_queries = self._measure(
+            f"_refresh_stock_data ({len(self.forecasts)})", self.forecasts._refresh_stock_data, 'manual'
+        )
+        extra_records = len(self.forecasts) - len(self.small)
+        self.assertLessEqual(
+            large_queries, small_queries + QUERY_MARGIN + extra_records,
+            f"_refresh_stock_data: {small_queries} consultas con {len(self.small)} líneas "
+            f"y {large_queries} con {len(self.forecasts)}",
+        )
+
+    def test_compute_current_stock_query_count(self):
+        self.assertConstantQueries("_compute_current_stock", '_compute_current_stock')
+
+    def test_compute_incoming_stock_query_count(self):
+        self.assertConstantQueries("_compute_incoming_stock", '_compute_incoming_stock')
+
+    def test_compute_sales_data_query_count(self):
+        self.assertConstantQueries("_compute_sales_data", '_compute_sales_data')
+
+    def test_compute_projection_query_count(self):
+        self.assertConstantQueries("_compute_projection", '_compute_projection')
+
+    def test_compute_forecast_demand_query_count(self):
+        self.forecasts.forecast_model = 'holt_winters'
+        self.assertConstantQueries("_compute_forecast_demand", '_compute_forecast_demand')
+
+    def test_order_wizard_query_count(self):
+        self.assertConstantQueries("action_launch_order_wizard", 'action_launch_order_wizard')
+
+    def test_refresh_values(self):
+        """Los cálculos por lotes dan lo mismo que las búsquedas línea a línea."""
+        self.forecasts.action_refresh_stock_data()
+        end_date = datetime.now()
+        for forecast in self.small:
+            sale_lines = self.env['sale.order.line'].search([
+                ('order_id.date_order', '>=', end_date - timedelta(days=forecast.months_history * 30.44)),
+                ('order_id.date_order', '<=', end_date),
+                ('order_id.state', 'in', ['sale', 'done']),
+                ('product_id', '=', forecast.product_id.id)
+            ])
+            self.assertAlmostEqual(forecast.total_sold, sum(sale_lines.mapped('product_uom_qty')))
+            incoming_moves = self.env['stock.move'].search(forecast._get_incoming_stock_domain())
+            self.assertAlmostEqual(forecast.incoming_stock, sum(incoming_moves.mapped('product_uom_qty')))
+
+    def test_refresh_unchanged_components(self):
+        """Recalcular solo el stock entrante, sin cambios, cuesta menos que el recálculo completo."""
+        self.forecasts.action_refresh_stock_data()
+        self.env.invalidate_all()
+        _res, _elapsed, full_queries = self._measure(
+            "_refresh_stock_data (todo)", self.forecasts._refresh_stock_data, 'manual'
+        )
+        self.env.invalidate_all()
+        _res, _elapsed, incoming_queries = self._measure(
+            "_refresh_stock_data (incoming)", self.forecasts._refresh_stock_data, 'po_confirm', ('incoming',)
+        )
+        self.assertLess(incoming_queries, full_queries)
@@ -0,0 +1,173 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from odoo import fields
+from odoo.tests import tagged
+
+from .common import StockForecastDatasetCase
+
+
+@tagged('post_install', '-at_install')
+class TestStockForecastRefresh(StockForecastDatasetCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.forecasts = cls._generate_dataset(4, 20, 4, 1)
+        cls.queue = cls.env['stock.forecast.refresh.queue']
+
+    def test_done_moves_enqueued_once(self):
+        """Los movimientos hechos en la transacción se encolan una sola vez, al hacer commit."""
+        products = self.forecasts.product_id
+        quants = self.env['stock.quant'].with_context(inventory_mode=True).create([{
+            'product_id': product.id,
+            'location_id': self.warehouse.lot_stock_id.id,
+            'inventory_quantity': 100,
+        } for product in products])
+        quants.action_apply_inventory()
+        self.assertFalse(self.queue.search([('product_id', 'in', products.ids)]))
+
+        self.env.cr.precommit.run()
+        queued = self.queue.search([('product_id', 'in', products.ids)])
+        self.assertEqual(queued.product_id, products)
+        self.assertTrue(all(queued.mapped('refresh_current')))
+        self.assertFalse(any(queued.mapped('refresh_incoming')))
+
+    def test_done_moves_sync_refresh(self):
+        """En modo 'sync' el stock a mano se actualiza tras el commit."""
+        self.env['ir.config_parameter'].sudo().set_param('muemue_stock_forecast.refresh_mode', 'sync')
+        forecast = self.forecasts[0]
+        before = forecast.current_stock
+        self.env['stock.quant'].with_context(inventory_mode=True).create({
+            'product_id': forecast.product_id.id,
+            'location_id': self.warehouse.lot_stock_id.id,
+            'inventory_quantity': 25,
+        }).action_apply_inventory()
+
+        self.env.cr.precommit.run()
+        self.env.cr.postcommit.run()
+        forecast.invalidate_recordset()
+        self.assertAlmostEqual(forecast.current_stock, before + 25)
+
+    def test_incoming_reschedule_enqueued(self):
+        """Cambiar la fecha prevista de una recepción encola el entrante, que recalcula la proyección."""
+        move = self.env['stock.move'].search([
+            ('product_id', 'in', self.forecasts.product_id.ids),
+            ('picking_code', '=', 'incoming'),
+            ('state', 'not in', ('draft', 'done', 'cancel')),
+        ], limit=1)
+        forecast = self.forecasts.filtered(lambda f: f.product_id == move.product_id)
+        # Dentro del periodo de previsión: el total entrante no cambia
+        move.picking_id.scheduled_date = fields.Datetime.now() + timedelta(days=1)
+        queued = self.queue.search([('product_id', '=', move.product_id.id)])
+        self.assertTrue(queued.refresh_incoming)
+
+        self.queue._cron_process_queue()
+        stored = (forecast.min_projected_stock, forecast.projected_stockout_date)
+        forecast._compute_projection()
+        self.assertEqual((forecast.min_projected_stock, forecast.projected_stockout_date), stored)
+
+    def test_projection_by_chunks(self):
+        """La proyección por bloques da lo mismo que con una sola matriz."""
+        self.forecasts._compute_projection()
+        expected = [(f.min_projected_stock, f.projected_stockout_date) for f in self.forecasts]
+        with patch('odoo.addons.muemue_stock_forecast.models.stock_forecast.PROJECTION_CHUNK_CELLS', 1):
+            self.forecasts._compute_projection()
+        self.assertEqual(
+            [(f.min_projected_stock, f.projected_stockout_date) for f in self.forecasts], expected)
+
+    def test_sale_confirm_enqueued(self):
+        """En modo 'queue' confirmar un pedido solo encola las ventas del producto."""
+        forecast = self.forecasts[0]
+        before = forecast.total_sold
+        order = self.env['sale.order'].create({
+            'partner_id': self.customer.id,
+            'order_line': [(0, 0, {'product_id': forecast.product_id.id, 'product_uom_qty': 7})],
+        })
+        order.action_confirm()
+        self.assertEqual(forecast.total_sold, before)
+        queued = self.queue.search([('product_id', '=', forecast.product_id.id)])
+        self.assertTrue(queued.refresh_sales)
+        self.assertFalse(queued.refresh_current or queued.refresh_incoming)
+
+        self.queue._cron_process_queue()
+        forecast.invalidate_recordset()
+        self.assertAlmostEqual(forecast.total_sold, before + 7)
+
+    def test_confirmed_line_edit(self):
+        """Modificar una línea de un pedido confirmado corrige el histórico mensual y la ventana."""
+        sales_month = self.env['stock.forecast.sales.month']
+        forecast = self.forecasts[0]
+        order = self.env['sale.order'].create({
+            'partner_id': self.customer.id,
+            'order_line': [(0, 0, {'product_id': forecast.product_id.id, 'product_uom_qty': 7})],
+        })
+        order.action_confirm()
+        self.queue._cron_process_queue()
+        before = forecast.total_sold
+
+        order.order_line.product_uom_qty = 10
+        history = sorted(sales_month.search([]).mapped(lambda m: (m.product_id, m.month, m.quantity)))
+        sales_month._rebuild()
+        self.assertEqual(
+            history, sorted(sales_month.search([]).mapped(lambda m: (m.product_id, m.month, m.quantity))))
+
+        self.queue._cron_process_queue()
+        forecast.invalidate_recordset()
+        self.assertAlmostEqual(forecast.total_sold, before + 3)
+
+    def test_sale_confirm_sync(self):
+        """En modo 'sync' confirmar un pedido suma sus cantidades en el momento."""
+        self.env['ir.config_parameter'].sudo().set_param('muemue_stock_forecast.refresh_mode', 'sync')
+        forecast = self.forecasts[0]
+        before = forecast.total_sold
+        order = self.env['sale.order'].create({
+            'partner_id': self.customer.id,
+            'order_line': [(0, 0, {'product_id': forecast.product_id.id, 'product_uom_qty': 7})],
+        })
+        order.action_confirm()
+        self.assertAlmostEqual(forecast.total_sold, before + 7)
+
+    def test_warehouse_stock_written_by_refresh(self):
+        """El compute del stock actual no toca el desglose por almacén; el recálculo sí."""
+        forecast = self.forecasts[0]
+        self.env['stock.quant'].with_context(inventory_mode=True).create({
+            'product_id': forecast.product_id.id,
+            'location_id': self.warehouse.lot_stock_id.id,
+            'inventory_quantity': 40,
+        }).action_apply_inventory()
+        breakdown = forecast.warehouse_stock_ids.mapped('quantity')
+
+        forecast._compute_current_stock()
+        forecast.invalidate_recordset(['warehouse_stock_ids'])
+        self.assertEqual(forecast.warehouse_stock_ids.mapped('quantity'), breakdown)
+
+        forecast._refresh_stock_data('manual', ('current',))
+        self.assertAlmostEqual(sum(forecast.warehouse_stock_ids.mapped('quantity')), forecast.current_stock)
+
+    def test_warehouse_stock_on_create(self):
+        """Las líneas creadas por el ORM nacen con su desglose por almacén."""
+        product = self.env['product.product'].create({'name': 'Breakdown Product', 'detailed_type': 'product'})
+        self.env['stock.quant'].with_context(inventory_mode=True).create({
+            'product_id': product.id,
+            'location_id': self.warehouse.lot_stock_id.id,
+            'inventory_quantity': 15,
+        }).action_apply_inventory()
+        forecast = self.env['stock.forecast'].create({'product_id': product.id})
+        self.assertEqual(forecast.warehouse_stock_ids.warehouse_id, self.warehouse)
+        self.assertAlmostEqual(forecast.warehouse_stock_ids.quantity, 15)
+
+    def test_manual_refresh_recomputes_dated_fields(self):
+        """El recálculo manual recalcula demanda y proyección aunque no cambien sus entradas."""
+        forecast = self.forecasts[0]
+        forecast.action_refresh_stock_data()
+        expected = (forecast.forecast_demand, forecast.min_projected_stock)
+        # Simula valores calculados en otro mes
+        self.env.flush_all()
+        self.env.cr.execute(
+            "UPDATE stock_forecast SET forecast_demand = -1, min_projected_stock = -1 WHERE id = %s",
+            [forecast.id],
+        )
+        forecast.invalidate_recordset(['forecast_demand', 'min_projected_stock'])
+        forecast.action_refresh_stock_data()
+        self.assertEqual((forecast.forecast_demand, forecast.min_projected_stock), expected)
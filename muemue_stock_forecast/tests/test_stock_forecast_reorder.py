@@ -0,0 +1,94 @@
+from odoo.tests import tagged
+
+from .common import StockForecastDatasetCase
+
+
+@tagged('post_install', '-at_install')
+class TestStockForecastReorder(StockForecastDatasetCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.forecasts = cls._generate_dataset(30, 600, 0, 1)
+        cls.env['ir.config_parameter'].sudo().set_param('muemue_stock_forecast.reorder_batch_size', 7)
+
+    def test_generate_reorder_proposals(self):
+        """El job crea una solicitud por proveedor con las mismas cantidades que el asistente."""
+        to_order = self.forecasts.filtered('need_reorder')
+        expected = {
+            rec.product_id: (supplier, quantity)
+            for rec, supplier, quantity in to_order._get_order_proposals()
+            if supplier and quantity > 0
+        }
+        self.assertTrue(expected)
+
+        purchase_orders = self.env['purchase.order'].browse(
+            self.env['stock.forecast']._cron_generate_reorder_proposals())
+        self.assertTrue(all(po.state == 'draft' for po in purchase_orders))
+        self.assertEqual(len(purchase_orders), len(purchase_orders.partner_id))
+        ordered = {
+            line.product_id: (line.order_id.partner_id, line.product_qty)
+            for line in purchase_orders.order_line
+        }
+        self.assertEqual(ordered, expected)
+
+        # Relanzarlo no duplica líneas: los productos ya están en borrador
+        self.env['stock.forecast']._cron_generate_reorder_proposals()
+        self.assertEqual(len(purchase_orders.order_line), len(expected))
+
+    def test_reorder_request_keeps_user_and_company(self):
+        """El botón deja una petición con su usuario y compañía, que el job atiende y borra."""
+        request_model = self.env['stock.forecast.reorder.request']
+        self.forecasts.action_generate_reorder_proposals()
+        reorder_request = request_model.search([])
+        self.assertEqual(reorder_request.user_id, self.env.user)
+        self.assertEqual(reorder_request.company_id, self.env.company)
+
+        purchase_orders = self.env['purchase.order'].browse(
+            self.env['stock.forecast']._cron_generate_reorder_proposals())
+        self.assertTrue(purchase_orders)
+        self.assertEqual(purchase_orders.company_id, self.env.company)
+        self.assertFalse(request_model.search([]))
+
+    def test_archived_supplier_ignored(self):
+        """Como _select_seller, el proveedor por defecto nunca es un contacto archivado."""
+        forecast = self.forecasts[0]
+        supplier = forecast.main_supplier_id
+        archived = self.env['res.partner'].create({'name': 'Archived Supplier'})
+        self.env['product.supplierinfo'].create({
+            'partner_id': archived.id,
+            'product_tmpl_id': forecast.product_id.product_tmpl_id.id,
+            'sequence': 0,
+            'price': 1.0,
+        })
+        self.assertEqual(forecast.main_supplier_id, archived)
+        archived.action_archive()
+        self.assertEqual(forecast.main_supplier_id, supplier)
+        self.assertEqual(forecast.product_id._select_seller().partner_id, supplier)
+
+    def test_main_supplier_follows_price(self):
+        """Entre tarifas de la misma secuencia manda la más barata, también al cambiar el precio."""
+        forecast = self.forecasts[0]
+        supplier = forecast.main_supplier_id
+        other = self.env['res.partner'].create({'name': 'Cheaper Supplier'})
+        other_seller = self.env['product.supplierinfo'].create({
+            'partner_id': other.id,
+            'product_tmpl_id': forecast.product_id.product_tmpl_id.id,
+            'price': 1000.0,
+        })
+        self.assertEqual(forecast.main_supplier_id, supplier)
+        other_seller.price = 1.0
+        self.assertEqual(forecast.main_supplier_id, other)
+
+    def test_append_to_draft_merges_lines(self):
+        """Al reutilizar una solicitud en borrador, la cantidad se suma a la línea del mismo producto."""
+        forecast = self.forecasts[0]
+        product, supplier = forecast.product_id, forecast.main_supplier_id
+        order_wizard = self.env['stock.order.wizard']
+        purchase_order = order_wizard._create_purchase_orders({supplier: [(product, 5)]})
+        self.assertEqual(
+            order_wizard._create_purchase_orders({supplier: [(product, 3)]}, append_to_draft=True),
+            purchase_order,
+        )
+        self.assertEqual(len(purchase_order.order_line), 1)
+        self.assertEqual(purchase_order.order_line.product_qty, 8)